@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+'''Regression check of the FM peak finder
+
+Builds seeded synthetic max projections (gaussian beads of varying size and brightness,
+touching pairs and noise) and compares the peaks of Peak_finding.peak_finding with
+those of the original per-label implementation, which is kept below as the reference.
+Also reports the time taken by both.
+
+Usage (from the repository root):
+    python benchmarks/peak_regression.py [-n 5] [--size 1024] [--beads 400] [--seed 1]
+
+Exits with status 1 if any peak list differs.
+'''
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+from scipy import ndimage as ndi
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from clement.peak_finding import Peak_finding
+
+
+def reference_peaks(img, threshold, pixel_lower_threshold, pixel_upper_threshold, flood_steps, roi_min_size):
+    ''' Peaks of the original implementation, one full-image find_objects call per large label '''
+    img = np.copy(img)
+    img[img < threshold] = 0
+    labels, num_objects = ndi.label(img)
+    label_size = np.bincount(labels.ravel())
+
+    mask_sp = np.where((label_size >= pixel_lower_threshold) & (label_size < pixel_upper_threshold), True, False)
+    if sum(mask_sp) == 0:
+        coor_sp = []
+    else:
+        label_mask_sp = mask_sp[labels.ravel()].reshape(labels.shape)
+        labels_sp = label_mask_sp * labels
+        labels_sp, n_s = ndi.label(labels_sp)
+        coor_sp = ndi.center_of_mass(img, labels_sp, range(1, labels_sp.max() + 1))
+
+    mask_mp = np.where((label_size >= pixel_upper_threshold) & (label_size < np.max(label_size)), True, False)
+    if sum(mask_mp) > 0:
+        label_mask_mp = mask_mp[labels.ravel()].reshape(labels.shape)
+        labels_mp = label_mask_mp * labels
+        labels_mp, n_m = ndi.label(labels_mp)
+        for i in range(1, sum(mask_mp) + 1):
+            objects = ndi.find_objects((labels_mp == i).astype(int))
+            if len(objects) == 0:
+                return None
+            slice_x, slice_y = objects[0]
+            roi_i = np.copy(img[slice_x, slice_y])
+            max_i = np.max(roi_i)
+            step = (0.95 * max_i - threshold) / flood_steps
+            multiple = False
+            coor_tmp = np.array(ndi.center_of_mass(roi_i, ndi.label(roi_i)[0]))
+            for k in range(1, flood_steps + 1):
+                new_threshold = threshold + k * step
+                roi_i[roi_i < new_threshold] = 0
+                labels_roi, n_i = ndi.label(roi_i)
+                if n_i > 1:
+                    roi_label_size = np.bincount(labels_roi.ravel())
+                    if np.max(roi_label_size[1:]) <= pixel_upper_threshold:
+                        if len(roi_label_size) == 3 and roi_label_size.min() < roi_min_size:
+                            break
+                        else:
+                            multiple = True
+                            coordinates_roi = np.array(ndi.center_of_mass(roi_i, labels_roi, range(1, n_i + 1)))
+                            for j in range(len(coordinates_roi)):
+                                coor_sp.append(coordinates_roi[j] + np.array((slice_x.start, slice_y.start)))
+                            break
+            if not multiple:
+                coor_sp.append(coor_tmp + np.array((slice_x.start, slice_y.start)))
+
+    coor = np.array(coor_sp)
+    if len(coor) == 0:
+        return None
+    return np.round(coor)
+
+
+def synthetic_projection(rng, size, num_beads):
+    ''' Max projection with gaussian beads, some of them overlapping, on a noisy background '''
+    img = np.zeros((size, size))
+    half = 15
+    for i in range(num_beads):
+        x, y = rng.uniform(half + 5, size - half - 5, 2)
+        sigma = rng.uniform(1.5, 7)
+        amplitude = rng.uniform(20, 100)
+        xs = slice(int(x) - half, int(x) + half)
+        ys = slice(int(y) - half, int(y) + half)
+        X, Y = np.mgrid[xs, ys]
+        img[xs, ys] += amplitude * np.exp(-((X - x) ** 2 + (Y - y) ** 2) / (2 * sigma ** 2))
+    img += rng.normal(0, 1, img.shape)
+    return img
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Clement peak finder regression check')
+    parser.add_argument('-n', '--repeats', type=int, default=5, help='Number of projections (default: 5)')
+    parser.add_argument('--size', type=int, default=1024, help='Projection size in pixels (default: 1024)')
+    parser.add_argument('--beads', type=int, default=400, help='Beads per projection (default: 400)')
+    parser.add_argument('--threshold', type=float, default=5, help='Intensity threshold (default: 5)')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed (default: 1)')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    failed = 0
+    for i in range(args.repeats):
+        img = synthetic_projection(rng, args.size, args.beads)
+        finder = Peak_finding(threshold=args.threshold)
+        finder.print = finder.log = lambda *a: None
+        finder.num_slices = 1
+
+        start = time.time()
+        ref = reference_peaks(img, finder.threshold, finder.pixel_lower_threshold, finder.pixel_upper_threshold,
+                              finder.flood_steps, finder.roi_min_size)
+        t_ref = time.time() - start
+        start = time.time()
+        finder.peak_finding(img, False)
+        t_new = time.time() - start
+        new = finder.peak_slices[-1]
+
+        same = (ref is None and new is None) or (ref is not None and new is not None and np.array_equal(ref, new))
+        failed += not same
+        print('Projection %d: %s peaks (reference %s), %.3f s vs %.3f s, %s' %
+              (i, 0 if new is None else len(new), 0 if ref is None else len(ref), t_new, t_ref,
+               'identical' if same else 'DIFFERENT'))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
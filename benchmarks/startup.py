@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+'''Startup benchmark for the Clement GUI
+
+Measures the import time of clement.gui with python -X importtime, lists the slowest
+modules, and measures the wall time from interpreter start until the main window has
+been shown. Every measurement runs in a fresh interpreter.
+
+Usage (from the repository root):
+    python benchmarks/startup.py [-n 5] [--top 15] [--target 1.0] [--no-window]
+
+Exits with status 1 if the median time to window exceeds --target seconds, and with
+status 2 if the window could not be built, in which case only the imports are reported.
+'''
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import subprocess
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+WINDOW_SCRIPT = '''
+import sys
+from PyQt5 import QtWidgets, QtCore
+from clement import gui
+app = QtWidgets.QApplication(sys.argv[:1])
+app.setStyle('fusion')
+window = gui.GUI(no_restore=True)
+def shown():
+    print('SHOWN', __import__('time').time(), flush=True)
+    app.quit()
+QtCore.QTimer.singleShot(0, shown)
+app.exec_()
+'''
+
+
+def _run(args, cwd):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = REPO + os.pathsep + env.get('PYTHONPATH', '')
+    return subprocess.run([sys.executable] + args, cwd=cwd, env=env, stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE, universal_newlines=True)
+
+
+def import_times(cwd):
+    ''' Returns {module: (self_us, cumulative_us)} for importing clement.gui '''
+    proc = _run(['-X', 'importtime', '-c', 'import clement.gui'], cwd)
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr)
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cum_us, name = line[len('import time:'):].split('|')
+        times[name.strip()] = (int(self_us), int(cum_us))
+    return times
+
+
+def time_to_window(cwd):
+    ''' Seconds from launching the interpreter until the main window is shown '''
+    start = time.time()
+    proc = _run(['-c', WINDOW_SCRIPT], cwd)
+    for line in proc.stdout.splitlines():
+        if line.startswith('SHOWN'):
+            return float(line.split()[1]) - start
+    raise RuntimeError(proc.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Clement startup benchmark')
+    parser.add_argument('-n', '--repeats', type=int, default=5, help='Number of runs (default: 5)')
+    parser.add_argument('--top', type=int, default=15, help='Number of slowest modules to list (default: 15)')
+    parser.add_argument('--target', type=float, default=1.0, help='Time to window goal in s (default: 1.0)')
+    parser.add_argument('--no-window', help='Only measure imports', action='store_true')
+    args = parser.parse_args()
+
+    # The GUI writes its log into the working directory
+    with tempfile.TemporaryDirectory() as cwd:
+        runs = [import_times(cwd) for i in range(args.repeats)]
+        total = sorted(r['clement.gui'][1] for r in runs)[len(runs) // 2]
+        print('import clement.gui: %.3f s (median of %d)' % (total / 1e6, len(runs)))
+        print('Slowest modules (self time of the median run):')
+        median_run = min(runs, key=lambda r: abs(r['clement.gui'][1] - total))
+        for name, (self_us, cum_us) in sorted(median_run.items(), key=lambda k: -k[1][0])[:args.top]:
+            print('  %8.1f ms  %8.1f ms cumulative  %s' % (self_us / 1e3, cum_us / 1e3, name))
+
+        if args.no_window:
+            return 0
+        try:
+            window = sorted(time_to_window(cwd) for i in range(args.repeats))
+        except RuntimeError as err:
+            print('Time to window: not measured, the window could not be built:')
+            print('  ' + str(err).strip().splitlines()[-1])
+            return 2
+        median = window[len(window) // 2]
+        print('Time to window: %.3f s (median of %d, min %.3f s, target %.3f s)' %
+              (median, len(window), window[0], args.target))
+        return 0 if median <= args.target else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
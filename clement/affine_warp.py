@@ -0,0 +1,56 @@
+import numpy as np
+from . import parallel
+
+
+class Affine_warp():
+    '''Resamples images through a shared inverse-mapped coordinate field
+
+    Equivalent to ndi.affine_transform(image, np.linalg.inv(matrix), output_shape=...)
+    applied channel by channel, but the coordinate field is computed once per
+    (matrix, output_shape) and reused for every channel and every source image.
+    Warped results are remembered per name, so asking again for the same source
+    under the same transform does not resample it again.
+    '''
+    def __init__(self, order=1):
+        self.order = order
+        self._key = None
+        self._coords = None
+        self._results = {}
+
+    def _get_key(self, matrix, output_shape):
+        return (np.asarray(matrix, dtype='f8').tobytes(), tuple(int(s) for s in output_shape))
+
+    def get_coords(self, matrix, output_shape):
+        ''' Input coordinates (2, *output_shape) of every output pixel '''
+        key = self._get_key(matrix, output_shape)
+        if key != self._key:
+            inv_matrix = np.linalg.inv(matrix)
+            grid = np.indices(output_shape, dtype='f8').reshape(2, -1)
+            coords = inv_matrix[:2, :2] @ grid + inv_matrix[:2, 2:]
+            self._coords = coords.reshape((2,) + tuple(output_shape))
+            self._key = key
+            self._results = {}
+        return self._coords
+
+    def warp(self, image, matrix, output_shape, name=None):
+        ''' Warps 2D image or every channel of (nx, ny, nchannels) image '''
+        from scipy import ndimage as ndi
+        coords = self.get_coords(matrix, output_shape)
+        if name is not None and name in self._results and self._results[name][0] is image:
+            return self._results[name][1]
+
+        if image.ndim == 2:
+            result = ndi.map_coordinates(image, coords, order=self.order)
+        else:
+            result = np.empty(tuple(output_shape) + (image.shape[-1],), dtype=image.dtype)
+            parallel.pmap(lambda i: ndi.map_coordinates(image[:, :, i], coords, output=result[:, :, i],
+                                                        order=self.order), range(image.shape[-1]))
+
+        if name is not None:
+            self._results[name] = (image, result)
+        return result
+
+    def clear(self):
+        self._key = None
+        self._coords = None
+        self._results = {}
@@ -2,9 +2,12 @@ import numpy as np
 from PyQt5 import QtWidgets, QtGui, QtCore
 import pyqtgraph as pg
 import copy
-import matplotlib
+import os
 
 from . import utils
+from . import point_transforms
+from .pyramid import Pyramid
+from .em_operations import EM_ops
 
 class PeakROI(pg.CircleROI):
     def __init__(self, pos, size, parent, movable=False, removable=False, resizable=False, color=None):
@@ -50,6 +53,270 @@ class PeakROI(pg.CircleROI):
     def peakRefined(self, refined_pos):
         self.original_pos = refined_pos
 
+class PeakOverlay():
+    '''FM peaks shown on an EM view as a single ScatterPlotItem
+
+    All peaks are drawn by one item with per-spot pens and are looked up through
+    KD-trees on their original and current positions. Only the peaks the user clicks on are promoted
+    to PeakROI objects (see promote()), which then replace their spot in the scatter plot.
+    Positions are the top-left corners of the peak circles, as for PeakROI.
+    '''
+    def __init__(self, imview, positions, size, colors=None):
+        from scipy.spatial import cKDTree
+        self.imview = imview
+        self.size = size
+        self.pos = np.array(positions, dtype='f8').reshape(-1, 2)
+        self.original_pos = np.copy(self.pos)
+        self.colors = colors
+        self.hidden = np.zeros(len(self.pos), dtype=bool)
+        self.rois = {}
+        self.click_callback = None
+        self.tree = cKDTree(self.original_pos) if len(self.pos) > 0 else None
+        self._current_tree = None
+
+        default_pen = pg.mkPen((255, 0, 0))  # PeakROI.original_color
+        if colors is None:
+            self._pens = None
+            self._default_pen = default_pen
+        else:
+            self._pens = np.array([default_pen if c is None else pg.mkPen(c) for c in colors], dtype=object)
+        self.scatter = pg.ScatterPlotItem(pxMode=False, brush=pg.mkBrush(None))
+        self.scatter.sigClicked.connect(self._clicked)
+        self.imview.addItem(self.scatter)
+        self.update()
+
+    def __len__(self):
+        return len(self.pos)
+
+    def update(self):
+        visible = ~self.hidden
+        visible[list(self.rois)] = False
+        ind = np.flatnonzero(visible)
+        pen = self._default_pen if self._pens is None else list(self._pens[ind])
+        self.scatter.setData(pos=self.pos[ind] + self.size / 2, size=self.size, pen=pen,
+                             brush=pg.mkBrush(None), data=ind)
+
+    def _clicked(self, scatter, points):
+        if self.click_callback is not None and len(points) > 0:
+            self.click_callback(int(points[0].data()))
+
+    def query(self, positions, tol=1e-3, original=False):
+        ''' Indices of the peaks at the given (N, 2) positions, current or original '''
+        if self.tree is None:
+            return []
+        from scipy.spatial import cKDTree
+        positions = np.atleast_2d(np.asarray(positions, dtype='f8'))
+        if original:
+            return sorted(set(i for ind in self.tree.query_ball_point(positions, tol) for i in ind))
+
+        # The tree of current positions is rebuilt after every translation
+        if self._current_tree is None:
+            self._current_tree = cKDTree(self.pos)
+        found = set(i for ind in self._current_tree.query_ball_point(positions, tol) for i in ind)
+        # Promoted peaks moved by the user are found at their ROI instead
+        for ind, roi in self.rois.items():
+            if roi.has_moved:
+                found.discard(ind)
+                roi_pos = np.array([roi.pos().x(), roi.pos().y()])
+                if np.any(np.linalg.norm(positions - roi_pos, axis=1) <= tol):
+                    found.add(ind)
+        return sorted(found)
+
+    def promote(self, ind):
+        ''' Replaces the spot of peak ind by a PeakROI and returns it '''
+        if ind not in self.rois:
+            color = None if self.colors is None else self.colors[ind]
+            roi = PeakROI(QtCore.QPointF(*self.pos[ind]), self.size, self.imview.getImageItem(), color=color)
+            roi.original_pos = np.copy(self.original_pos[ind])
+            self.rois[ind] = roi
+            self.update()
+        return self.rois[ind]
+
+    def set_roi(self, ind, roi):
+        self.rois[ind] = roi
+        self.update()
+
+    def index_of(self, roi):
+        for ind, r in self.rois.items():
+            if r is roi:
+                return ind
+
+    def moved(self):
+        ''' Indices of the promoted peaks that were moved by the user '''
+        return sorted(ind for ind, roi in self.rois.items() if roi.has_moved)
+
+    def hide(self, indices):
+        for ind in indices:
+            if ind in self.rois and not self.hidden[ind]:
+                self.imview.removeItem(self.rois[ind])
+        self.hidden[indices] = True
+        self.update()
+
+    def restore(self, indices):
+        for ind in indices:
+            if ind in self.rois:
+                self.rois[ind].resetPos()
+                if self.hidden[ind]:
+                    self.imview.addItem(self.rois[ind])
+        self.hidden[indices] = False
+        self.update()
+
+    def translate(self, shift, skip=None):
+        ''' Shifts all peaks, promoted peaks that were moved individually keep their place '''
+        self.pos += shift
+        self._current_tree = None
+        for ind, roi in self.rois.items():
+            if ind != skip and not roi.has_moved:
+                roi.setPos(self.pos[ind], finish=False)
+        self.update()
+
+    def remove(self):
+        self.imview.removeItem(self.scatter)
+        [self.imview.removeItem(roi) for roi in self.rois.values()]
+        self.rois = {}
+
+
+class TiledImageItem(pg.ImageItem):
+    '''ImageItem that only renders the visible part of the image
+
+    The visible tiles are taken from the pyramid level matching the current zoom, so
+    panning and zooming over a huge montage only touches a screen-sized amount of data.
+    Item coordinates stay those of the full image, so points and ROIs attached to the
+    item are unaffected by the displayed level. An external pyramid (e.g. from EM_ops)
+    can be passed with set_pyramid(), otherwise one is built when needed.
+    Histograms are computed from the cached subsample of the pyramid.
+
+    This overrides ImageItem internals (render, paint, quickMinMax, getHistogram and the
+    qimage/autoDownsample attributes) as found in pyqtgraph 0.11.0rc0, which is pinned in
+    setup.py and environment.yml. Check this class when upgrading pyqtgraph.
+    '''
+    def __init__(self, *args, **kwargs):
+        super(TiledImageItem, self).__init__(*args, **kwargs)
+        self.pyramid = None
+        self._render_key = None
+        self._render_rect = None
+        # Makes the item re-render when the view transform changes
+        self.setAutoDownsample(True)
+
+    def set_pyramid(self, pyramid):
+        self.pyramid = pyramid
+        self.qimage = None
+        self.update()
+
+    def get_pyramid(self, data=None):
+        if data is None:
+            data = self.image
+        if self.pyramid is None or not self.pyramid.is_for(data):
+            self.pyramid = Pyramid(data)
+        return self.pyramid
+
+    def _get_visible(self):
+        ''' (level, x0, x1, y0, y1) of the tile-aligned visible region, None if nothing is visible '''
+        o = self.mapToDevice(QtCore.QPointF(0, 0))
+        x = self.mapToDevice(QtCore.QPointF(1, 0))
+        y = self.mapToDevice(QtCore.QPointF(0, 1))
+        if o is None or x is None or y is None:
+            return
+        w = pg.Point(x - o).length()
+        h = pg.Point(y - o).length()
+        if w == 0 or h == 0:
+            return
+
+        pyramid = self.get_pyramid()
+        level = pyramid.get_level(1. / max(w, h))
+        nx, ny = pyramid.shapes[level]
+        vb = self.getViewBox()
+        if vb is None:
+            return (level, 0, nx, 0, ny)
+        rect = self.mapRectFromView(vb.viewRect())
+        if self.axisOrder == 'col-major':
+            xmin, xmax, ymin, ymax = rect.left(), rect.right(), rect.top(), rect.bottom()
+        else:
+            xmin, xmax, ymin, ymax = rect.top(), rect.bottom(), rect.left(), rect.right()
+
+        scale = 2 ** level * pyramid.tile_size
+        t = pyramid.tile_size
+        x0 = max(0, int(np.floor(xmin / scale)) * t)
+        x1 = min(nx, int(np.ceil(xmax / scale)) * t)
+        y0 = max(0, int(np.floor(min(ymin, ymax) / scale)) * t)
+        y1 = min(ny, int(np.ceil(max(ymin, ymax) / scale)) * t)
+        if x1 <= x0 or y1 <= y0:
+            return
+        return (level, x0, x1, y0, y1)
+
+    def render(self):
+        if self.image is None or self.image.size == 0:
+            return
+        key = self._get_visible()
+        self._render_key = key
+        if key is None:
+            self.qimage = None
+            return
+
+        level, x0, x1, y0, y1 = key
+        s = 2 ** level
+        nx, ny = self.pyramid.shapes[0]
+        rect = (x0 * s, y0 * s, min(x1 * s, nx) - x0 * s, min(y1 * s, ny) - y0 * s)
+        self._render_rect = QtCore.QRectF(*rect) if self.axisOrder == 'col-major' else \
+                            QtCore.QRectF(rect[1], rect[0], rect[3], rect[2])
+
+        full_image = self.image
+        self.image = self.pyramid.get_region(level, x0, x1, y0, y1)
+        self.autoDownsample = False
+        try:
+            super(TiledImageItem, self).render()
+        finally:
+            self.image = full_image
+            self.autoDownsample = True
+
+    def paint(self, p, *args):
+        if self.image is None:
+            return
+        if self.qimage is None:
+            self.render()
+            if self.qimage is None:
+                return
+        if self.paintMode is not None:
+            p.setCompositionMode(self.paintMode)
+        p.drawImage(self._render_rect, self.qimage)
+        if self.border is not None:
+            p.setPen(self.border)
+            p.drawRect(self.boundingRect())
+
+    def viewTransformChanged(self):
+        # Only re-render when a different set of tiles becomes visible
+        if self.image is not None and self._get_visible() != self._render_key:
+            self.qimage = None
+            self.update()
+
+    def quickMinMax(self, targetSize=1e6):
+        sample = self.get_pyramid().get_sample()
+        return np.nanmin(sample), np.nanmax(sample)
+
+    def getHistogram(self, *args, **kwargs):
+        if self.image is None or self.image.size == 0:
+            return None, None
+        full_image = self.image
+        self.image = self.get_pyramid().get_sample()
+        try:
+            return super(TiledImageItem, self).getHistogram(*args, **kwargs)
+        finally:
+            self.image = full_image
+
+
+class TiledImageView(pg.ImageView):
+    ''' ImageView displaying through a TiledImageItem, with levels estimated from its cached subsample '''
+    def __init__(self, *args, **kwargs):
+        if 'imageItem' not in kwargs:
+            kwargs['imageItem'] = TiledImageItem()
+        super(TiledImageView, self).__init__(*args, **kwargs)
+
+    def quickMinMax(self, data):
+        if data.ndim in (2, 3) and self.axes['t'] is None:
+            data = self.imageItem.get_pyramid(data).get_sample()
+        return super(TiledImageView, self).quickMinMax(data)
+
+
 class BaseControls(QtWidgets.QWidget):
     def __init__(self):
         super(BaseControls, self).__init__()
@@ -113,6 +380,9 @@ class BaseControls(QtWidgets.QWidget):
         self.show_merge = False
         self.progress = 0
         self.cov_matrix = None
+        self._precision_tasks = {}
+        self._loader_task = None
+        self._bar_value = 0
 
     def _init_ui(self):
         self.log('This message should not be seen. Please override _init_ui')
@@ -166,11 +436,7 @@ class BaseControls(QtWidgets.QWidget):
             self.progress_bar.setValue(100)
         else:
             self.progress_bar.setValue(0)
-        if self.other._refined:
-            self.err_btn.setText('x: \u00B1{:.2f}, y: \u00B1{:.2f}'.format(self.other._std[idx][0],
-                                                                           self.other._std[idx][1]))
-        else:
-            self.err_btn.setText('0')
+        self._show_precision(idx)
 
         if self.other.ops is None or not self.other.ops._transformed:
             return
@@ -410,6 +676,8 @@ class BaseControls(QtWidgets.QWidget):
         return tf_cov
 
     def _draw_fm_pois(self, init, item):
+        import matplotlib.cm
+        import matplotlib.colors
         cmap = matplotlib.cm.get_cmap('cool')
         lin = np.linspace(0, 1, 100)
         colors = cmap(lin)
@@ -568,15 +836,19 @@ class BaseControls(QtWidgets.QWidget):
 
         self.other._points_corr_indices.append(self.counter - 1)
 
-        for i in range(len(self.other.peaks)):
-            if self.other.peaks[i].pos() == self.other._points_corr[-1].pos():
-                self.other.imview.removeItem(self.other.peaks[i])
+        if len(self.other.peaks) > 0:
+            corr_pos = self.other._points_corr[-1].pos()
+            self.other.peaks.hide(self.other.peaks.query([corr_pos.x(), corr_pos.y()]))
 
     @utils.wait_cursor('print')
     def _show_FM_peaks(self, state=None):
+        import matplotlib.cm
+        import matplotlib.colors
+        from scipy.spatial import cKDTree
         if not self.show_peaks_btn.isChecked():
             # Remove already shown peaks
-            [self.imview.removeItem(point) for point in self.peaks]
+            if isinstance(self.peaks, PeakOverlay):
+                self.peaks.remove()
             self.translate_peaks_btn.setChecked(False)
             self.translate_peaks_btn.setEnabled(False)
             self.refine_peaks_btn.setChecked(False)
@@ -602,8 +874,9 @@ class BaseControls(QtWidgets.QWidget):
             self.print('Fitting Z-positions of FM peaks')
             self.other.fm_sem_corr = self.other.ops.update_fm_sem_matrix(self.other.orig_fm_sem_corr, self.other._fib_flips)
 
-        if len(self.peaks) != 0:
-            self.peaks = []
+        if isinstance(self.peaks, PeakOverlay):
+            self.peaks.remove()
+        self.peaks = []
 
         if self.ops._transformed:
             self.other._update_tr_matrices()
@@ -612,78 +885,73 @@ class BaseControls(QtWidgets.QWidget):
             diff_normed = self.other.diff / self.other.diff.max()
             diff_abs = np.sqrt(diff_normed[:,0]**2 + diff_normed[:,1]**2)
             colors = cmap(diff_abs)
+        # All peaks are mapped at once and drawn as a single scatter plot
+        tf_peaks = np.asarray(self.other.ops.tf_peak_slices[-1])
         if self.tab_index == 1:
-            for i in range(len(self.other.ops.tf_peak_slices[-1])):
-                z = self.other.ops.calc_z(i, self.other.ops.tf_peaks_z[i], self.other.ops._transformed)
-                init = np.array(
-                    [self.other.ops.tf_peak_slices[-1][i, 0], self.other.ops.tf_peak_slices[-1][i, 1], 1])
-                transf = np.dot(self.tr_matrices, init)
-                transf = self.ops.fib_matrix @ np.array([transf[0], transf[1], z, 1])
-                if self._refined:
-                    transf = self.ops._refine_matrix @ np.array([transf[0], transf[1], 1])
-                pos = QtCore.QPointF(transf[0] - self.orig_size / 2, transf[1] - self.orig_size / 2)
-                color = None
-                if self.other.diff is not None:
-                    idx = np.where(np.isclose(np.array(self.other.refined_points), np.array([transf[0], transf[1]])))
-                    if not np.array_equal(idx[0], np.array([])):
-                        if len(idx) == 2:
-                            idx = idx[0][0]
-                        color = colors[idx]
-                        color = matplotlib.colors.to_hex(color)
-                point = PeakROI(pos, self.size, self.imview.getImageItem(), color=color)
-                self.peaks.append(point)
-                for i in range(len(self._orig_points_corr)):
-                    if np.allclose(transf[:2], self._orig_points_corr[i]):
-                        self.imview.removeItem(point)
+            z = [self.other.ops.calc_z(i, self.other.ops.tf_peaks_z[i], self.other.ops._transformed)
+                 for i in range(len(tf_peaks))]
+            transf = point_transforms.apply(self.tr_matrices, tf_peaks)
+            transf = point_transforms.apply(self.ops.fib_matrix, np.column_stack([transf, z]))[:, :2]
+            if self._refined:
+                transf = point_transforms.apply(self.ops._refine_matrix, transf)
+            size = self.size
         else:
-            for peak in self.other.ops.tf_peak_slices[-1]:
-                init = np.array([peak[0], peak[1], 1])
-                if self.show_btn.isChecked():
-                    transf = np.linalg.inv(self.ops.tf_matrix) @ self.tr_matrices @ init
-                else:
-                    transf = self.tr_matrices @ init
-                pos = QtCore.QPointF(transf[0] - self.orig_size / 2, transf[1] - self.orig_size / 2)
-                color = None
-                if self.other.diff is not None:
-                    idx = np.where(np.isclose(np.array(self.other.refined_points), np.array([transf[0], transf[1]])))
-                    if not np.array_equal(idx[0], np.array([])):
-                        if len(idx) == 2:
-                            idx = idx[0][0]
-                        color = colors[idx]
-                        color = matplotlib.colors.to_hex(color)
-                point = PeakROI(pos, self.orig_size, self.imview.getImageItem(), color=color)
-                self.peaks.append(point)
-                # Remove FM beads information
-                for i in range(len(self._orig_points_corr)):
-                    if np.allclose(transf[:2], self._orig_points_corr[i]):
-                        self.imview.removeItem(point)
-
-        self.peaks = np.array(self.peaks)
+            if self.show_btn.isChecked():
+                matrix = point_transforms.inverse(self.ops.tf_matrix) @ self.tr_matrices
+            else:
+                matrix = self.tr_matrices
+            transf = point_transforms.apply(matrix, tf_peaks)
+            size = self.orig_size
+
+        peak_colors = None
+        if self.other.diff is not None and len(self.other.refined_points) > 0:
+            # Peaks that were used for the refinement are colored by their residual
+            tree = cKDTree(np.array(self.other.refined_points))
+            dist, ind = tree.query(transf)
+            matched = dist < 1e-2
+            peak_colors = [matplotlib.colors.to_hex(colors[i]) if m else None for i, m in zip(ind, matched)]
+        self.peaks = PeakOverlay(self.imview, transf - self.orig_size / 2, size, colors=peak_colors)
+        self.peaks.click_callback = self._peak_clicked
+        # Remove FM beads information
+        if len(self._orig_points_corr) > 0:
+            self.peaks.hide(self.peaks.query(np.array(self._orig_points_corr) - self.orig_size / 2, tol=1e-2))
+
         self.translate_peaks_btn.setEnabled(True)
         self.refine_peaks_btn.setEnabled(True)
 
+    def _peak_clicked(self, ind):
+        ''' Promotes a clicked peak to a draggable ROI while translating or refining peaks '''
+        if self.translate_peaks_btn.isChecked():
+            roi = self.peaks.promote(ind)
+            roi.translatable = True
+            roi.sigRegionChangeFinished.connect(self._translate_peaks_slot)
+        elif self.refine_peaks_btn.isChecked():
+            roi = self.peaks.promote(ind)
+            roi.translatable = True
+            roi.sigRegionChangeFinished.connect(lambda pt=roi: self._peak_to_poi(pt))
+
     def _translate_peaks(self, active):
+        if not isinstance(self.peaks, PeakOverlay):
+            return
         if active:
             self.show_grid_btn.setChecked(False)
             self.refine_peaks_btn.setChecked(False)
-            for p in self.peaks:
+            for p in self.peaks.rois.values():
                 p.translatable = True
                 p.sigRegionChangeFinished.connect(self._translate_peaks_slot)
-            self._old_peak_pos = [[p.pos().x(), p.pos().y()] for p in self.peaks]
         else:
-            for p in self.peaks:
-                p.sigRegionChangeFinished.disconnect()
+            for p in self.peaks.rois.values():
+                try:
+                    p.sigRegionChangeFinished.disconnect()
+                except TypeError:
+                    pass
                 p.translatable = False
 
     def _translate_peaks_slot(self, item):
-        ind = np.where(item == self.peaks)[0][0]
-        shift = item.pos() - self._old_peak_pos[ind]
+        ind = self.peaks.index_of(item)
+        shift = np.array([item.pos().x(), item.pos().y()]) - self.peaks.pos[ind]
         self.log(ind, shift)
-        for i in range(len(self.peaks)):
-            self._old_peak_pos[i][0] += shift.x()
-            self._old_peak_pos[i][1] += shift.y()
-            if i != ind and not self.peaks[i].has_moved:
-                self.peaks[i].setPos(self._old_peak_pos[i], finish=False)
+        self.peaks.translate(shift, skip=ind)
 
     def _refine_peaks(self, active):
         if self.other.ops is not None:
@@ -700,11 +968,12 @@ class BaseControls(QtWidgets.QWidget):
                 return
             self.show_grid_btn.setChecked(False)
             self.translate_peaks_btn.setChecked(False)
-            for p in self.peaks:
-                p.translatable = True
-                p.sigRegionChangeFinished.connect(lambda pt=p: self._peak_to_poi(pt))
-        else:
-            for p in self.peaks:
+            if isinstance(self.peaks, PeakOverlay):
+                for p in self.peaks.rois.values():
+                    p.translatable = True
+                    p.sigRegionChangeFinished.connect(lambda pt=p: self._peak_to_poi(pt))
+        elif isinstance(self.peaks, PeakOverlay):
+            for p in self.peaks.rois.values():
                 #p.sigRegionChangeFinished.disconnect()
                 p.translatable = False
 
@@ -713,8 +982,8 @@ class BaseControls(QtWidgets.QWidget):
         if idx is None:
             peak.peakMoved(None)
             self.imview.removeItem(peak)
-            ref_ind = [i for i in range(len(self.peaks)) if self.peaks[i] == peak]
-            pos = self.other.ops.tf_peak_slices[-1][ref_ind[0]]
+            ref_ind = self.peaks.index_of(peak)
+            pos = self.other.ops.tf_peak_slices[-1][ref_ind]
             point = QtCore.QPointF(pos[0] - self.other.size / 2, pos[1] - self.other.size / 2)
             self.other._draw_correlated_points(point, self.imview.getImageItem())
             self._points_corr[-1].setPos(peak.pos())
@@ -850,12 +1119,12 @@ class BaseControls(QtWidgets.QWidget):
         if len(self.other._points_corr) == 0:
             if self.peaks is None or len(self.peaks) == 0:
                 return
-            ref_ind = [i for i in range(len(self.peaks)) if self.peaks[i].has_moved]
+            ref_ind = self.peaks.moved()
             points_em = []
             for ind in ref_ind:
-                self.imview.removeItem(self.peaks[ind])
-                pos = self.peaks[ind].pos()
-                original_positions.append(self.peaks[ind].original_pos)
+                self.imview.removeItem(self.peaks.rois[ind])
+                pos = self.peaks.rois[ind].pos()
+                original_positions.append(self.peaks.rois[ind].original_pos)
                 points_em.append(pos + np.array([self.size /2, self.size /2]))
             points_em = np.array(points_em)
             moved_peaks = True
@@ -863,7 +1132,7 @@ class BaseControls(QtWidgets.QWidget):
             points_em = np.array([[p.x() + self.size / 2, p.y() + self.size / 2] for p in self._points_corr])
             [self.imview.removeItem(point) for point in self._points_corr]
 
-        points_em_fitted = self.ops.fit_circles(points_em, bead_size)
+        points_em_fitted, fitted = self.ops.fit_circles(points_em, bead_size, refit=self.refit_btn.isChecked())
         self._points_corr = []
         circle_size_em = bead_size * 1e3 / self.ops.pixel_size[0]
         self.size = circle_size_em
@@ -872,10 +1141,12 @@ class BaseControls(QtWidgets.QWidget):
                                  points_em_fitted[i, 1] - circle_size_em / 2)
 
             point = PeakROI(pos, circle_size_em, parent=self.imview.getImageItem(), movable=True)
-            point.peakMoved(item=None)
+            # Beads that could not be fitted keep the color of an unrefined point
+            if fitted[i] or moved_peaks:
+                point.peakMoved(item=None)
             if moved_peaks:
                 point.original_pos = copy.copy(original_positions[i])
-                self.peaks[ref_ind[i]] = point
+                self.peaks.set_roi(ref_ind[i], point)
             else:
                 self._points_corr.append(point)
             self.imview.addItem(point)
@@ -911,16 +1182,10 @@ class BaseControls(QtWidgets.QWidget):
             self._points_raw.remove(self._points_raw[idx])
 
         #Remove FM beads information
-        for i in range(len(self.peaks)):
-            pos = [self.peaks[i].original_pos[0] + self.orig_size/2, self.peaks[i].original_pos[1] + self.orig_size/2]
-            if np.allclose(pos, self._orig_points_corr[idx]):
-                self.peaks[i].resetPos()
-                self.imview.addItem(self.peaks[i])
-        for i in range(len(self.other.peaks)):
-            pos = [self.other.peaks[i].original_pos[0] + self.other.orig_size / 2, self.other.peaks[i].original_pos[1] + self.other.orig_size / 2]
-            if np.allclose(pos, self.other._orig_points_corr[idx]):
-                self.other.peaks[i].resetPos()
-                self.other.imview.addItem(self.other.peaks[i])
+        for controls in (self, self.other):
+            if len(controls.peaks) > 0:
+                pos = np.array(controls._orig_points_corr[idx]) - controls.orig_size / 2
+                controls.peaks.restore(controls.peaks.query(pos, tol=1e-2, original=True))
 
         self.imview.removeItem(self._points_corr[idx])
         self._points_corr.remove(self._points_corr[idx])
@@ -1380,6 +1645,7 @@ class BaseControls(QtWidgets.QWidget):
         self.other._orig_points_corr = []
 
     def _undo_refinement(self):
+        self._cancel_precision(self.other.tab_index)
         self.other.ops.undo_refinement()
         for i in range(len(self._points_corr)):
             self._remove_correlated_points(self._points_corr[0])
@@ -1465,18 +1731,158 @@ class BaseControls(QtWidgets.QWidget):
         self.diff = np.array(sel_points) - np.array(self.refined_points)
         self.log(self.diff.shape)
         self.diff *= self.other.ops.pixel_size[0]
-        self.other.cov_matrix, self.other._std[idx][0], self.other._std[idx][1], self.other._dist = self.other.ops.calc_error(self.diff)
 
-        self.other._err[idx] = self.diff
-        self.err_btn.setText(
-            'x: \u00B1{:.2f}, y: \u00B1{:.2f}'.format(self.other._std[idx][0], self.other._std[idx][1]))
+        # The statistics are computed in the background, the plots are filled in when they are ready.
+        # Until then the view keeps the statistics of its previous refinement.
+        self._cancel_precision(idx)
+        other = self.other
+        diff = np.copy(self.diff)
+        min_points = self.min_conv_points - 4
+        num_conv_points = self.min_conv_points
+
+        def estimate(task):
+            task.progress('Estimating error distribution...')
+            error = other.ops.calc_error(diff)
+            if task.cancelled:
+                return
+            convergence = []
+            if len(corr_points) >= num_conv_points:
+                task.progress('Estimating RMS convergence...')
+                convergence = other.ops.calc_convergence(corr_points, sel_points, min_points, refine_matrix_old)
+            return error, convergence
+
+        task = utils.BackgroundTask(estimate)
+        task.signals.progress.connect(self.print)
+        task.signals.finished.connect(lambda result: self._precision_estimated(task, other, idx, diff, result))
+        task.signals.failed.connect(lambda trace: self._precision_failed(task, other, idx, trace))
+        self._precision_tasks[idx] = task.start()
+        self._show_precision(idx)
+
+    def _precision_estimated(self, task, other, idx, diff, result):
+        if self._precision_tasks.get(idx) is not task:
+            return
+        del self._precision_tasks[idx]
+        error, convergence = result
+        other.cov_matrix, other._std[idx][0], other._std[idx][1], other._dist = error
+        self.log('Covariance matrix: ', other.cov_matrix)
+        other._err[idx] = diff
+        other._conv[idx] = convergence
+        if other is self.other:
+            self._show_precision(idx)
+        if len(convergence) > 0:
+            self.print('RMS error: ', convergence[2][-1])
+        else:
+            self.print('Done')
+
+    def _precision_failed(self, task, other, idx, trace):
+        if self._precision_tasks.get(idx) is not task:
+            return
+        del self._precision_tasks[idx]
+        self.print(trace)
+        self.print('Precision estimate failed, keeping the previous statistics')
+        if other is self.other:
+            self._show_precision(idx)
+
+    def _cancel_precision(self, idx):
+        ''' Cancels the estimate of view idx, which keeps its previous statistics '''
+        task = self._precision_tasks.pop(idx, None)
+        if task is not None:
+            task.cancel()
+            if self.other is not None and self.other.tab_index == idx:
+                self._show_precision(idx)
+
+    def is_estimating(self, idx):
+        ''' True while the precision of view idx is being estimated '''
+        return idx in self._precision_tasks
+
+    def _show_precision(self, idx):
+        if idx in self._precision_tasks:
+            self.err_btn.setText('Estimating...')
+        elif self.other._refined and self.other._std[idx][0] is not None:
+            self.err_btn.setText('x: \u00B1{:.2f}, y: \u00B1{:.2f}'.format(self.other._std[idx][0],
+                                                                           self.other._std[idx][1]))
+        else:
+            self.err_btn.setText('0')
+
+    def _assemble_mrc(self, state=None, background=True):
+        if self.step_box.text() == '':
+            self._downsampling = 10
+        else:
+            self._downsampling = self.step_box.text()
+
+        if self._file_name != '':
+            if len(self.ops.dimensions) == 3:
+                # Tiles are assembled into a new ops object, the displayed one stays untouched until done
+                step, file_name = int(self._downsampling), self._file_name
+                h, eh, pixel_size, old_fname = self.ops.h, self.ops.eh, self.ops.pixel_size, self.ops.old_fname
+
+                def assemble(task):
+                    ops = EM_ops(task.print, task.log)
+                    ops.h, ops.eh, ops.pixel_size, ops.old_fname = h, eh, pixel_size, old_fname
+                    ops.parse_3d(step, file_name, progress=task.set_progress)
+                    return ops
 
-        if len(corr_points) >= self.min_conv_points:
-            min_points = self.min_conv_points - 4
-            convergence = self.other.ops.calc_convergence(corr_points, sel_points, min_points, refine_matrix_old)
-            self.other._conv[idx] = convergence
+                self._start_loader(assemble, self._mrc_assembled, 'Assembling tiles', background)
+            else:
+                self._mrc_assembled(self.ops)
+        else:
+            self.print('You have to choose a file first!')
+
+    def _start_loader(self, func, on_loaded, name, background=True):
+        '''Runs func(task) to load data and passes its result to on_loaded in the GUI thread
+
+        func must not touch the GUI, it builds a new ops object that on_loaded takes over.
+        A loader that is still running for this view is replaced. Without background
+        func runs right away, as needed when restoring a project.
+        '''
+        if self._loader_task is not None:
+            self._loader_task.cancel()
+            self._loader_task = None
         else:
-            self.other._conv[idx] = []
+            self._bar_value = self._progress_bar().value()
+        task = utils.BackgroundTask(func)
+        task.signals.printed.connect(lambda args: self.print(*args))
+        task.signals.logged.connect(lambda args: self.log(*args))
+        task.signals.progress.connect(self.print)
+        task.signals.advanced.connect(lambda done, total: self._progress_bar().setValue(int(100 * done / total)))
+        self.print(name + '...')
+        if not background:
+            result = func(task)
+            self._loader_done(name + ' done')
+            on_loaded(result)
+            return
+        task.signals.finished.connect(lambda result: self._loader_finished(task, on_loaded, result, name + ' done'))
+        task.signals.failed.connect(lambda trace: self._loader_finished(task, self.print, trace, name + ' failed'))
+        self._loader_task = task.start()
+        self.cancel_load_btn.setEnabled(True)
+
+    def _loader_finished(self, task, on_loaded, result, message):
+        if task is not self._loader_task:
+            return
+        self._loader_task = None
+        self.cancel_load_btn.setEnabled(False)
+        self._loader_done(message)
+        on_loaded(result)
+
+    def _progress_bar(self):
+        # Only the FM controls have a progress bar, the EM views share it
+        return self.progress_bar if hasattr(self, 'progress_bar') else self.other.progress_bar
+
+    def _loader_done(self, message):
+        # The bar shows the merge state of the view again once loading is over
+        self._progress_bar().setValue(self._bar_value)
+        self.print(message)
+
+    def _cancel_loader(self, state=None):
+        ''' Cancels the running loader, the view keeps showing the previously loaded file '''
+        if self._loader_task is not None:
+            self._loader_task.cancel()
+            self._loader_task = None
+            self.cancel_load_btn.setEnabled(False)
+            self._progress_bar().setValue(self._bar_value)
+            if hasattr(self, 'mrc_fname'):
+                self.mrc_fname.setText(os.path.basename(self._file_name) if self._file_name else '')
+            self.print('Loading cancelled')
 
     def correct_grid_z(self):
         self.ops.fib_matrix = None
@@ -1506,22 +1912,21 @@ class BaseControls(QtWidgets.QWidget):
 
         if self.tab_index != 1:
             if self.ops.merged[self.tab_index] is None:
-                for i in range(self.other.ops.num_channels):
-                    if self.show_assembled_btn.isChecked():
-                        show_region = False
-                        #self.ops.apply_merge_2d(self.other.ops.orig_data, self.other.ops.tf_matrix_orig,
-                        #                        self.other.ops.data.shape, self.other.ops.points, i)
-                    else:
-                        show_region = True
-                    self.ops.apply_merge_2d(self.other.ops.data[:,:,i], self.other.ops.points, i,
-                                            show_region, self.other.ops.num_channels, self.tab_index)
-                    self.other.progress_bar.setValue((i + 1) / self.other.ops.num_channels * 100)
+                if self.show_assembled_btn.isChecked():
+                    show_region = False
+                    #self.ops.apply_merge_2d(self.other.ops.orig_data, self.other.ops.tf_matrix_orig,
+                    #                        self.other.ops.data.shape, self.other.ops.points, i)
+                else:
+                    show_region = True
+                self.ops.apply_merge_2d(self.other.ops.data, self.other.ops.points, show_region,
+                                        self.other.ops.num_channels, self.tab_index,
+                                        progress=lambda done, total: self.other.progress_bar.setValue(
+                                            int(100 * done / total)))
+                self.other.progress_bar.setValue(100)
                 self.progress = 100
             else:
                 self.other.progress_bar.setValue(100)
                 self.progress = 100
-            if self.ops.merged[self.tab_index] is not None:
-                self.print('Merged shape: ', self.ops.merged[self.tab_index].shape)
             self.show_merge = True
             return True
         else:
@@ -1574,15 +1979,14 @@ class BaseControls(QtWidgets.QWidget):
             dst_sorted = np.array(
                 sorted(self.other.ops.points, key=lambda k: [np.cos(60 * np.pi / 180) * k[0] + k[1]]))
             tr_matrices = self.ops.get_transform(src_sorted, dst_sorted)
-            tf_points = np.array([(tr_matrices @ np.array([point[0], point[1], 1]))[:2] for point in points])
+            tf_points = point_transforms.apply(tr_matrices, np.array(points))
         elif hasattr(self.other, 'select_btn') and self.tab_index != 1:
             src_sorted = np.array(
                 sorted(self.other.ops.points, key=lambda k: [np.cos(60 * np.pi / 180) * k[0] + k[1]]))
             dst_sorted = np.array(
                 sorted(self.ops.points, key=lambda k: [np.cos(60 * np.pi / 180) * k[0] + k[1]]))
             tr_matrices = self.other.ops.get_transform(src_sorted, dst_sorted)
-            tf_points = np.array(
-                [(np.linalg.inv(tr_matrices) @ np.array([point[0], point[1], 1]))[:2] for point in points])
+            tf_points = point_transforms.apply(point_transforms.inverse(tr_matrices), np.array(points))
         else:
             return
         xmin = tf_points.min(0)[0]
@@ -0,0 +1,62 @@
+import weakref
+from collections import OrderedDict
+import numpy as np
+
+
+class Display_cache():
+    '''LRU cache of arrays derived from a source array for display
+
+    Entries are keyed by the identity of the source array and a tuple describing
+    the derivation (transform matrix, flips, view mode, ...). The source is only
+    weakly referenced, so a replaced source can be freed and its entries can never
+    be returned for a new array that happens to reuse its id. The least recently
+    used entries are dropped once the cached arrays exceed max_bytes.
+    '''
+    def __init__(self, max_bytes=1024**3):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+
+    @staticmethod
+    def hash_matrix(matrix):
+        ''' Hashable key for a transform matrix, None stays None '''
+        if matrix is None:
+            return None
+        return np.asarray(matrix, dtype='f8').tobytes()
+
+    def get(self, source, key):
+        full_key = (id(source),) + tuple(key)
+        entry = self._entries.get(full_key)
+        if entry is None:
+            return
+        if entry[0]() is not source:
+            self._remove(full_key)
+            return
+        self._entries.move_to_end(full_key)
+        return entry[1]
+
+    def put(self, source, key, array):
+        full_key = (id(source),) + tuple(key)
+        if full_key in self._entries:
+            self._remove(full_key)
+        # Views of other arrays do not hold memory of their own
+        nbytes = array.nbytes if array.base is None else 0
+        self._entries[full_key] = (weakref.ref(source), array, nbytes)
+        self._bytes += nbytes
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            self._remove(next(iter(self._entries)))
+        return array
+
+    def get_or_compute(self, source, key, func):
+        ''' Cached array for (source, key), calling func() to create it if missing '''
+        array = self.get(source, key)
+        if array is None:
+            array = self.put(source, key, func())
+        return array
+
+    def _remove(self, full_key):
+        self._bytes -= self._entries.pop(full_key)[2]
+
+    def clear(self):
+        self._entries = OrderedDict()
+        self._bytes = 0
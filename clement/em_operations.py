@@ -3,16 +3,19 @@ import glob
 import os
 import numpy as np
 import copy
-import mrcfile as mrc
-from scipy import ndimage as ndi
-from scipy import signal as sc
-from skimage import transform as tf
-from skimage import io, measure, feature
-from sklearn import cluster, mixture
-import tifffile
 from .ransac import Ransac
+from .pyramid import Pyramid
+from .display_cache import Display_cache
+from . import point_transforms
+from . import error_stats
+from . import parallel
 import time
-import random
+
+
+def _is_compressed(fname):
+    with open(fname, 'rb') as f:
+        magic = f.read(3)
+    return magic[:2] == b'\x1f\x8b' or magic == b'BZh'
 
 
 class EM_ops():
@@ -35,6 +38,11 @@ class EM_ops():
         self.tf_data = None
         self.pixel_size = None  # should be in nanometer
         self.old_fname = None
+        self._mrc = None
+        self._mrc_fname = None
+        self._pyramid = None
+        self.display_cache = Display_cache()
+        # May be a read-only view of the MRC file, so it is never modified in place
         self.data = None
         self.stacked_data = False
         self.orig_region = None
@@ -49,9 +57,8 @@ class EM_ops():
         self.tf_grid_points = []
         self.side_length = None
         self.mcounts = None
-        self.tf_mcounts = None
-        self.count_map = None
-        self.tf_count_map = None
+        self.tile_map = None
+        self.tf_tile_matrix = None
         self.tf_matrix = np.identity(3)
         self.tf_matrix_orig = np.identity(3)
         self.tf_matrix_orig_region = np.identity(3)
@@ -82,6 +89,8 @@ class EM_ops():
         self.z_shift = None
 
     def parse_2d(self, fname):
+        import tifffile
+        from skimage import io
         if '.tif' in fname or '.tiff' in fname:
             # Transposing tif images by default
             self.data = np.array(io.imread(fname).T)
@@ -93,8 +102,9 @@ class EM_ops():
                 self.pixel_size = np.array([md['Scan']['PixelWidth'], md['Scan']['PixelHeight']]) * 1e9
             except KeyError:
                 self.print('No pixel size found! This might cause the program to crash at some point...')
+            self.orig_data = np.copy(self.data)
         else:
-            f = mrc.open(fname, 'r', permissive=True)
+            f = self._open_mrc(fname)
             if f.data is None:
                 self.print('Data is empty! Check file!')
                 return
@@ -106,13 +116,46 @@ class EM_ops():
             self.dimensions = np.array(f.data.shape)  # (dim_z, dim_y, dim_x)
             if len(self.dimensions) == 2:
                 self.stacked_data = False
-                self.data = np.copy(f.data)
-
-        self.orig_data = np.copy(self.data)
+                # Read-only view of the memory map, pages are only read when needed.
+                # Operations on data return new arrays, writing into it raises an error.
+                self.data = f.data
+            self.orig_data = self.data
         self.print('Pixel size: ', self.pixel_size)
 
-    def parse_3d(self, step, fname):
-        f = mrc.open(fname, 'r', permissive=True)
+    def get_pyramid(self):
+        ''' Multi-resolution pyramid of self.data, rebuilt only when the displayed array changes '''
+        if self._pyramid is None or not self._pyramid.is_for(self.data):
+            self._pyramid = Pyramid(self.data)
+        return self._pyramid
+
+    def _open_mrc(self, fname):
+        '''Returns read-only MRC file, kept open while the file is in use
+
+        Uncompressed files are memory-mapped, gzip and bzip2 files are decompressed into memory
+        '''
+        import mrcfile as mrc
+        if self._mrc is None or self._mrc_fname != fname:
+            self.close()
+            if _is_compressed(fname):
+                self._mrc = mrc.open(fname, 'r', permissive=True)
+            else:
+                self._mrc = mrc.mmap(fname, 'r', permissive=True)
+            self._mrc_fname = fname
+        return self._mrc
+
+    def close(self):
+        ''' Closes the MRC file, data read from it stays valid '''
+        if self._mrc is not None:
+            self._mrc.close()
+            self._mrc = None
+            self._mrc_fname = None
+
+    def __del__(self):
+        self.close()
+
+    def parse_3d(self, step, fname, progress=None):
+        ''' Assembles the tiles of a montage, progress(done, total) is called after every tile if given '''
+        f = self._open_mrc(fname)
         self.dimensions = np.array(f.data.shape)  # (dim_z, dim_y, dim_x)
         if len(self.dimensions) == 3 and self.dimensions[0] > 1:
             self.stacked_data = True
@@ -132,26 +175,42 @@ class EM_ops():
                               point + (0, self.dimensions[1], 0)]
                 self.grid_points.append(box_points)
 
-            cy, cx = np.indices(self.dimensions[1:3])
-
-            self.data = np.zeros((self.pos_x.max() + self.dimensions[2], self.pos_y.max() + self.dimensions[1]),
-                                 dtype='f4')
-            self.mcounts = np.zeros_like(self.data)
-            self.count_map = np.zeros_like(self.data)
+            nx, ny = self.dimensions[2], self.dimensions[1]
+            shape = (self.pos_x.max() + nx, self.pos_y.max() + ny)
+            self.data = np.zeros(shape, dtype='f4')
+            # Tiles are axis-aligned rectangles, so coverage and ownership are built from
+            # corner increments of a difference array and two in-place cumulative sums
+            counts = np.zeros((shape[0] + 1, shape[1] + 1), dtype='i4')
+            owner = np.zeros_like(counts)
             sys.stdout.write('Assembling images into %s-shaped array...' % (self.data.shape,))
             for i in range(self.dimensions[0]):
-                np.add.at(self.mcounts, (cx + self.pos_x[i], cy + self.pos_y[i]), 1)
-                np.add.at(self.data, (cx + self.pos_x[i], cy + self.pos_y[i]), f.data[i, ::step, ::step])
-                np.add.at(self.count_map, (cx + self.pos_x[i], cy + self.pos_y[i]), i)
+                x0, y0 = self.pos_x[i], self.pos_y[i]
+                # Tiles are read one at a time from the memory map
+                self.data[x0:x0 + nx, y0:y0 + ny] += f.data[i, ::step, ::step].T
+                for arr, val in ((counts, 1), (owner, i)):
+                    arr[x0, y0] += val
+                    arr[x0 + nx, y0] -= val
+                    arr[x0, y0 + ny] -= val
+                    arr[x0 + nx, y0 + ny] += val
+                if progress is not None:
+                    progress(i + 1, self.dimensions[0])
             sys.stdout.write('done\n')
-            self.data[self.mcounts > 0] /= self.mcounts[self.mcounts > 0]
-            self.count_map[self.mcounts > 1] = 0
+            for arr in (counts, owner):
+                np.cumsum(arr, 0, out=arr)
+                np.cumsum(arr, 1, out=arr)
+            self.mcounts = counts[:-1, :-1]
+            # Tile-id raster for point lookups: -1 outside all tiles, -2 where tiles overlap
+            self.tile_map = owner[:-1, :-1]
+            covered = self.mcounts > 0
+            self.tile_map[~covered] = -1
+            self.tile_map[self.mcounts > 1] = -2
+            self.data[covered] /= self.mcounts[covered]
 
-        f.close()
         self.print(self.data.shape)
-        self.orig_data = np.copy(self.data)
+        self.orig_data = self.data
 
     def save_merge(self, fname):
+        import mrcfile as mrc
         with mrc.new(fname, overwrite=True) as f:
             f.set_data(self.data)
             f.update_header_stats()
@@ -169,29 +228,29 @@ class EM_ops():
         if self.assembled:
             if self._transformed:
                 if self.tf_data is not None:
-                    self.data = copy.copy(self.tf_data)
+                    self.data = self.tf_data
                 else:
-                    self.data = copy.copy(self.orig_data)
+                    self.data = self.orig_data
                     self._transformed = False
                 self.points = copy.copy(self._tf_points)
             if not self._transformed:
-                self.data = copy.copy(self.orig_data)
+                self.data = self.orig_data
                 self.points = copy.copy(self._orig_points)
             self.tf_matrix = self.tf_matrix_orig
             self.tf_shape = self.tf_shape_orig
         else:
             if self._transformed:
                 if self.tf_region is not None:
-                    self.data = copy.copy(self.tf_region)
+                    self.data = self.tf_region
                 else:
-                    self.data = copy.copy(self.orig_region)
+                    self.data = self.orig_region
                     self._transformed = False
                 if self._tf_points_region is not None:
                     self.points = copy.copy(self._tf_points_region)
                 else:
                     self.points = None
             else:
-                self.data = np.copy(self.orig_region)
+                self.data = self.orig_region
                 self.points = copy.copy(self._orig_points_region)
             self.tf_matrix = self.tf_matrix_orig_region
             self.tf_shape = self.tf_shape_orig_region
@@ -205,6 +264,7 @@ class EM_ops():
         self.toggle_original()
 
     def calc_affine_transform(self, my_points):
+        from skimage import transform as tf
         my_points = self.calc_orientation(my_points)
         self.log('Input points:\n', my_points)
         side_list = np.linalg.norm(np.diff(my_points, axis=0), axis=1)
@@ -308,23 +368,26 @@ class EM_ops():
         return tf_matrix
 
     def apply_transform(self, pts):
+        from scipy import ndimage as ndi
         if self.tf_matrix is None:
             self.print('Calculate transform matrix first')
             return
         self._transformed = True
 
-        if len(self.dimensions) == 3 and self.dimensions[0] > 1:
-            self.tf_mcounts = ndi.affine_transform(self.mcounts, np.linalg.inv(self.tf_matrix), order=1,
-                                                   output_shape=self.tf_shape)
-            self.tf_count_map = ndi.affine_transform(self.count_map, np.linalg.inv(self.tf_matrix), order=1,
-                                                     output_shape=self.tf_shape)
+        if self.assembled and len(self.dimensions) == 3 and self.dimensions[0] > 1:
+            # Tile lookups in the transformed view map the point back through the inverse
+            # transform, so neither the coverage counts nor the tile map need to be warped
+            self.tf_tile_matrix = np.linalg.inv(self.tf_matrix)
 
+        # Re-applying a transform to the same source returns the cached result
+        key = ('transformed', Display_cache.hash_matrix(self.tf_matrix), tuple(self.tf_shape))
+        tf_data = self.display_cache.get_or_compute(
+            self.data, key, lambda: ndi.affine_transform(self.data, np.linalg.inv(self.tf_matrix), order=1,
+                                                         output_shape=self.tf_shape))
         if self.assembled:
-            self.tf_data = ndi.affine_transform(self.data, np.linalg.inv(self.tf_matrix), order=1,
-                                                output_shape=self.tf_shape)
+            self.tf_data = tf_data
         else:
-            self.tf_region = ndi.affine_transform(self.data, np.linalg.inv(self.tf_matrix), order=1,
-                                                  output_shape=self.tf_shape)
+            self.tf_region = tf_data
 
         self.transform_shift = -self.tf_corners.min(1)[:2]
 
@@ -332,13 +395,8 @@ class EM_ops():
         if self.assembled:
             self.tf_shape_orig = np.copy(self.tf_shape)
             self._tf_points = np.copy(pts)
-            self.tf_grid_points = []
-            for i in range(len(self.grid_points)):
-                tf_box_points = []
-                for point in self.grid_points[i]:
-                    x_i, y_i, z_i = self.tf_matrix @ point
-                    tf_box_points.append(np.array([x_i, y_i, z_i]))
-                self.tf_grid_points.append(tf_box_points)
+            # All (num_tiles, 4, 3) homogeneous box corners at once
+            self.tf_grid_points = list(np.array(self.grid_points) @ self.tf_matrix.T)
         else:
             self.tf_shape_orig_region = np.copy(self.tf_shape)
             self._tf_points_region = np.copy(pts)
@@ -390,14 +448,13 @@ class EM_ops():
             num_slices = 0
         else:
             num_slices *= scaling
-        src = np.zeros((points.shape[0], 4))
-        dst = np.zeros_like(src)
-        for i in range(points.shape[0]):
-            src[i, :] = [points[i, 0], points[i, 1], int(num_slices / 2), 1]
-            dst[i, :] = self.fib_matrix @ src[i, :]
-            if self._refine_matrix is not None:
-                dst[i, :3] = self._refine_matrix @ np.array([dst[i, 0], dst[i, 1], 1])
-        self.points = np.array(dst[:, :2])
+        src = np.zeros((points.shape[0], 3))
+        src[:, :2] = points[:, :2]
+        src[:, 2] = int(num_slices / 2)
+        dst = point_transforms.apply(self.fib_matrix, src)[:, :2]
+        if self._refine_matrix is not None:
+            dst = point_transforms.apply(self._refine_matrix, dst)
+        self.points = np.array(dst)
 
         if self.box_shift is None:
             com = self.points.mean(0)
@@ -407,37 +464,34 @@ class EM_ops():
         # if self._orig_points is None:
         self._orig_points = np.copy(self.points)
 
-    def get_selected_region(self, coordinate):
-        coordinate = coordinate.astype(int)
-        try:
-            if not self._transformed:
-                if (0 <= coordinate[0] < self.mcounts.shape[0]) and (0 <= coordinate[1] < self.mcounts.shape[1]):
-                    if self.mcounts[coordinate[0], coordinate[1]] > 1:
-                        self.print('Selected region ambiguous. Try again!')
-                        return
-                    else:
-                        counter = 0
-                        my_bool = False
-                        while not my_bool:
-                            x_range = np.arange(self.pos_x[counter], self.pos_x[counter] + self.dimensions[2])
-                            y_range = np.arange(self.pos_y[counter], self.pos_y[counter] + self.dimensions[1])
-                            if coordinate[0] in x_range and coordinate[1] in y_range:
-                                my_bool = True
-                            counter += 1
-                        self.print('Selected region: ', counter - 1)
-                        return counter - 1
-            else:
-                if (0 <= coordinate[0] < self.tf_count_map.shape[0]) and (
-                        0 <= coordinate[1] < self.tf_count_map.shape[1]):
-                    if self.tf_count_map[coordinate[0], coordinate[1]] == 0:
-                        self.print('Selected region ambiguous. Try again!')
-                        return
-                    else:
-                        counter = int(self.tf_count_map[coordinate[0], coordinate[1]])
-                        self.print('Selected region: ', counter)
-                        return counter
-        except(IndexError):
-            self.print('Watch out, index error. Try again!')
+    def _montage_pixel(self, coordinate, transformed=None):
+        ''' Pixel of the assembled montage under coordinate, None if outside '''
+        if transformed is None:
+            transformed = self._transformed
+        if transformed:
+            if self.tf_tile_matrix is None:
+                return
+            coordinate = point_transforms.apply(self.tf_tile_matrix, coordinate[:2])
+        coordinate = np.floor(coordinate).astype(int)
+        if self.tile_map is None or not ((0 <= coordinate[0] < self.tile_map.shape[0]) and
+                                         (0 <= coordinate[1] < self.tile_map.shape[1])):
+            return
+        return coordinate
+
+    def get_selected_region(self, coordinate, transformed=None):
+        ''' Index of the montage tile under coordinate, looked up in the tile-id raster '''
+        pixel = self._montage_pixel(coordinate, transformed)
+        if pixel is None:
+            return
+        tile = int(self.tile_map[pixel[0], pixel[1]])
+        if tile == -1:
+            self.print('Selected point is outside the montage. Try again!')
+            return
+        if tile == -2:
+            self.print('Selected region ambiguous. Try again!')
+            return
+        self.print('Selected region: ', tile)
+        return tile
 
     def select_region(self, coordinate, transformed):
         self.assembled = False
@@ -446,8 +500,8 @@ class EM_ops():
         if self.selected_region is None:
             return
         else:
-            with mrc.open(self.old_fname, 'r', permissive=True) as f:
-                self.orig_region = np.copy(f.data[self.selected_region].T)
+            # Zero-copy view of the tile in the memory map
+            self.orig_region = self._open_mrc(self.old_fname).data[self.selected_region].T
 
     def calc_stage_positions(self, clicked_points, downsampling):
         if self.eh is not None:
@@ -461,13 +515,11 @@ class EM_ops():
         else:
             self.stage_origin = 0
             self.pixel_size = np.array([1, 1])
-        inverse_matrix = np.linalg.inv(self.tf_matrix)
-        stage_positions = []
-        for i in range(len(clicked_points)):
-            point = np.array([clicked_points[i][0], clicked_points[i][1], 1])
-            coordinate_angstrom = (inverse_matrix @ point)[:2] * self.pixel_size[:2] * downsampling
-            coordinate_microns = coordinate_angstrom * 10 ** -4
-            stage_positions.append(coordinate_microns + self.stage_origin)  # stage position in microns
+        clicked_points = np.array([p[:2] for p in clicked_points], dtype='f8').reshape(-1, 2)
+        coordinate_angstrom = point_transforms.apply(point_transforms.inverse(self.tf_matrix), clicked_points) * \
+                              self.pixel_size[:2] * downsampling
+        coordinate_microns = coordinate_angstrom * 10 ** -4
+        stage_positions = list(coordinate_microns + self.stage_origin)  # stage position in microns
         self.log(stage_positions)
         return stage_positions
 
@@ -483,6 +535,7 @@ class EM_ops():
         self.fib_matrix[:2, 3] = shift
 
     def calc_refine_matrix(self, src, dst):
+        from skimage import transform as tf
         refine_matrix = tf.estimate_transform('affine', src, dst).params
         if self._refine_matrix is None:
             self._refine_matrix = refine_matrix
@@ -504,30 +557,33 @@ class EM_ops():
             points = np.copy(self._tf_points_region)
         update_points = True
         self.log(points)
-        for i in range(points.shape[0]):
-            point = np.array([points[i, 0], points[i, 1], 1])
-            points[i] = (self._refine_matrix @ point)[:2]
+        points = point_transforms.apply(self._refine_matrix, points)
         if update_points:
             self.points = points
 
     def undo_refinement(self):
         if len(self._refine_history) > 1:
-            self._refine_matrix = np.linalg.inv(self._refine_history[-1]) @ self._refine_matrix
-            for i in range(self.points.shape[0]):
-                point = np.array([self.points[i, 0], self.points[i, 1], 1])
-                self.points[i] = (np.linalg.inv(self._refine_history[-1]) @ point)[:2]
+            inv_refine = point_transforms.inverse(self._refine_history[-1])
+            self._refine_matrix = inv_refine @ self._refine_matrix
+            self.points = point_transforms.apply(inv_refine, self.points)
             del self._refine_history[-1]
         else:
             self.print('Data not refined!')
 
-    def fit_circles(self, points, bead_size):
-        points_model = []
-        successfull = False
+    def fit_circles(self, points, bead_size, refit=False):
+        '''Refines the bead centers at points by RANSAC circle fits to the edges around them
+
+        With refit, the best circle is refined by a least-squares fit to its inliers. Returns
+        the centers and a boolean array marking the beads that were fitted, the others keep
+        their original coordinate.
+        '''
+        from skimage import feature
         roi_size = int(
             np.round(bead_size * 1000 / self.pixel_size[0] + bead_size * 1000 / (2 * self.pixel_size[0])) / 2)
-        for i in range(len(points)):
-            x = int(np.round(points[i, 0]))
-            y = int(np.round(points[i, 1]))
+
+        def fit_bead(point):
+            x = int(np.round(point[0]))
+            y = int(np.round(point[1]))
             x_min = (x - roi_size) if (x - roi_size) > 0 else 0
             x_max = (x + roi_size) if (x + roi_size) < self.data.shape[0] else self.data.shape[0]
             y_min = (y - roi_size) if (y - roi_size) > 0 else 0
@@ -538,120 +594,92 @@ class EM_ops():
             coor_x, coor_y = np.where(edges != 0)
             if len(coor_x) != 0:
                 rad = bead_size * 1e3 / self.pixel_size[0] / 2  # bead size is supposed to be in microns
-                ransac = Ransac(coor_x, coor_y, 100, rad)
-                counter = 0
-                while True:
-                    try:
-                        ransac.run()
-                        successfull = True
-                        break
-                    except np.linalg.LinAlgError:
-                        counter += 1
-                        if counter == 100:
-                            break
-            if successfull:
-                if ransac.best_fit is not None:  # This should not happen, but it happens sometimes...
+                ransac = Ransac(coor_x, coor_y, 100, rad, refit=refit)
+                ransac.run()
+                # best_fit stays None if all sampled triples were collinear
+                if ransac.best_fit is not None:
                     cx, cy = ransac.best_fit[0], ransac.best_fit[1]
-                    coor = np.array([cx, cy]) + np.array([x, y]).T - np.array([roi_size, roi_size])
-                    points_model.append(coor)
-            else:
+                    return np.array([cx, cy]) + np.array([x, y]).T - np.array([roi_size, roi_size]), True
+            return np.array([x, y]), False
+
+        # Beads are fitted on the shared pool, messages are printed afterwards from this thread
+        points_model = []
+        fitted = []
+        for i, (coor, successfull) in enumerate(parallel.pmap(fit_bead, points)):
+            if not successfull:
                 self.print('Unable to fit bead #{}! Used original coordinate instead!'.format(i))
-                points_model.append(np.array([x, y]))
-        return np.array(points_model)
+            points_model.append(coor)
+            fitted.append(successfull)
+        return np.array(points_model), np.array(fitted, dtype=bool)
 
     def calc_error(self, diff):
-        clf = mixture.GaussianMixture(n_components=1, covariance_type='full')
-        clf.fit(diff)
-        cov = clf.covariances_[0]
-        max = np.max(np.abs(diff))
-        x = np.linspace(-max, max)
-        y = np.linspace(-max, max)
-        X, Y = np.meshgrid(x, y)
-        XX = np.array([X.ravel(), Y.ravel()]).T
-        Z = -clf.score_samples(XX)
-        Z = Z.reshape(X.shape)
-        f = np.exp(-Z)
-        f /= f.max()
-        self.log('Covariance matrix: ', cov)
-        return cov, np.sqrt(cov[0, 0]), np.sqrt(cov[1, 1]), f
-
-    def calc_convergence(self, corr_points, em_points, min_points, refine_matrix):
-        em_points = np.array(em_points)
-        corr_points = np.array(corr_points)
-
-        corr_points_refined = []
+        return error_stats.calc_error(diff)
+
+    def calc_convergence(self, corr_points, em_points, min_points, refine_matrix, num_iterations=100, seed=0):
+        '''RMS errors of affine fits to random subsets of min_points, min_points + 1, ... points
+
+        For every subset size num_iterations random subsets are drawn and all least squares
+        problems are solved at once. Returns the mean RMS error of the points in the subset
+        (refined), of the remaining points (free) and of all points for every subset size.
+        '''
+        em_points = np.array(em_points, dtype='f8')
+        corr_points = np.array(corr_points, dtype='f8')
+
         if refine_matrix is None:
             corr_points_refined = corr_points
         else:
-            for i in range(len(corr_points)):
-                p = np.array([corr_points[i, 0], corr_points[i, 1], 1])
-                p_new = refine_matrix @ p
-                corr_points_refined.append(p_new[:2])
-            # corr_points_refined = np.array(corr_points)
-            corr_points_refined = np.array(corr_points_refined)
-
-        num_sims = len(em_points) - min_points + 1
-        num_iterations = 100
-        precision_refined = []
-        precision_free = []
-        precision_all = []
-        num_points = min_points
-        for i in range(num_sims):
-            precision_i_refined = []
-            precision_i_free = []
-            precision_i_all = []
-            for k in range(num_iterations):
-                indices = random.sample(range(len(em_points)), num_points)
-                p_em = em_points[indices]
-                p_corr = corr_points_refined[indices]
-
-                refine_matrix = tf.estimate_transform('affine', p_corr, p_em).params
-                calc_points = []
-                for l in range(len(corr_points)):
-                    p = np.array([corr_points_refined[l, 0], corr_points_refined[l, 1], 1])
-                    p_refined = refine_matrix @ p
-                    calc_points.append(p_refined[:2])
-
-                diff_all = em_points - np.array(calc_points)
-                diff_refined = diff_all[indices]
-                diff_free = np.array([diff_all[i] for i in range(len(diff_all)) if i not in indices])
-
-                rms_all = np.sqrt(1 / len(diff_all) * (diff_all ** 2).sum())
-                rms_refined = np.sqrt(1 / len(diff_refined) * (diff_refined ** 2).sum())
-                if len(diff_free) > 0:
-                    rms_free = np.sqrt(1 / len(diff_free) * (diff_free ** 2).sum())
-                else:
-                    rms_free = 0
-                precision_i_refined.append(rms_refined)
-                precision_i_free.append(rms_free)
-                precision_i_all.append(rms_all)
-            precision_refined.append(np.mean(precision_i_refined))
-            precision_free.append(np.mean(precision_i_free))
-            precision_all.append(np.mean(precision_i_all))
-            num_points += 1
-
-        precision_refined = np.array(precision_refined) * self.pixel_size[0]
-        precision_free = np.array(precision_free) * self.pixel_size[0]
-        precision_all = np.array(precision_all) * self.pixel_size[0]
-        self.print('RMS error: ', precision_all[-1])
+            corr_points_refined = point_transforms.apply(refine_matrix, corr_points)
+
+        num = len(em_points)
+        sizes = np.arange(min_points, num + 1)
+        # Random subsets as the first k entries of random permutations, one row per (size, iteration)
+        rng = np.random.default_rng(seed)
+        ranks = np.argsort(np.argsort(rng.random((len(sizes), num_iterations, num)), axis=-1), axis=-1)
+        selected = (ranks < sizes[:, None, None]).astype('f8')
+
+        # Weighted normal equations of all affine fits corr -> em
+        design = np.column_stack([corr_points_refined, np.ones(num)])
+        ata = np.einsum('sin,nj,nk->sijk', selected, design, design)
+        atb = np.einsum('sin,nj,nk->sijk', selected, design, em_points)
+        params = np.linalg.pinv(ata) @ atb
+        sq_err = ((em_points - design @ params) ** 2).sum(-1)
+
+        num_free = num - sizes[:, None]
+        rms_refined = np.sqrt((selected * sq_err).sum(-1) / sizes[:, None])
+        with np.errstate(all='ignore'):
+            rms_free = np.where(num_free > 0, np.sqrt(((1 - selected) * sq_err).sum(-1) / num_free), 0)
+        rms_all = np.sqrt(sq_err.mean(-1))
+
+        precision_refined = rms_refined.mean(1) * self.pixel_size[0]
+        precision_free = rms_free.mean(1) * self.pixel_size[0]
+        precision_all = rms_all.mean(1) * self.pixel_size[0]
         return [precision_refined, precision_free, precision_all]
 
-    def apply_merge_2d(self, fm_data, fm_points, channel, show_region, num_channels, idx):
-        if channel == 0:
-            src = np.array(sorted(fm_points, key=lambda k: [np.cos(30 * np.pi / 180) * k[0] + k[1]]))
-            dst = np.array(sorted(self.points, key=lambda k: [np.cos(30 * np.pi / 180) * k[0] + k[1]]))
-            self.merge_matrix = tf.estimate_transform('affine', src, dst).params
-            if show_region:
-                em_data = self.orig_region
-            else:
-                em_data = self.orig_data
-            self.merged[idx] = np.zeros(em_data.shape + (num_channels + 1,))
-            self.merged[idx][:, :, -1] = em_data / em_data.max() * 100
-
-        tf_data = ndi.affine_transform(fm_data, np.linalg.inv(self.merge_matrix), order=1, output_shape=self.tf_shape)
-        orig_orientation = ndi.affine_transform(tf_data, self.tf_matrix, order=1, output_shape=self.merged[idx].shape[:2])
-
-        self.merged[idx][:, :, channel] = orig_orientation
+    def apply_merge_2d(self, fm_data, fm_points, show_region, num_channels, idx, progress=None):
+        '''Merges all channels of fm_data, the channels are warped on the shared pool
+
+        progress(done, total) is called from the calling thread after every channel if given
+        '''
+        from scipy import ndimage as ndi
+        from skimage import transform as tf
+        src = np.array(sorted(fm_points, key=lambda k: [np.cos(30 * np.pi / 180) * k[0] + k[1]]))
+        dst = np.array(sorted(self.points, key=lambda k: [np.cos(30 * np.pi / 180) * k[0] + k[1]]))
+        self.merge_matrix = tf.estimate_transform('affine', src, dst).params
+        if show_region:
+            em_data = self.orig_region
+        else:
+            em_data = self.orig_data
+        self.merged[idx] = np.zeros(em_data.shape + (num_channels + 1,))
+        self.merged[idx][:, :, -1] = em_data / em_data.max() * 100
+
+        def merge_channel(channel):
+            tf_data = ndi.affine_transform(fm_data[:, :, channel], np.linalg.inv(self.merge_matrix), order=1,
+                                           output_shape=self.tf_shape)
+            orig_orientation = ndi.affine_transform(tf_data, self.tf_matrix, order=1,
+                                                    output_shape=self.merged[idx].shape[:2])
+            self.merged[idx][:, :, channel] = orig_orientation
+
+        parallel.pmap(merge_channel, range(num_channels), progress=progress)
         self.print('Merged.shape: ', self.merged[idx].shape)
 
     #def apply_merge_3d(self, corr_matrix, fib_matrix, refine_matrix, fib_data, corr_points_fm, fm_z_values,
@@ -659,6 +687,7 @@ class EM_ops():
     def apply_merge_3d(self, fm_data_orig, corr_matrix, tf_matrix_fm, tf_corners_fm, color_matrices, flip_list,
                        corr_points_fm, orig_points, fm_z_values, corr_points_fib, channel, voxel_size,
                        num_slices, num_channels, norm_factor, idx):
+        from scipy import ndimage as ndi
         rot_matrix = np.identity(3)
         if flip_list[0]: #transp
             rot_matrix = np.array([[0, 1, 0], [1, 0, 0], [0, 0, 1]])
@@ -714,8 +743,7 @@ class EM_ops():
             self.merge_shift = np.mean(tf_points, axis=0) - np.mean(corr_points_fib_red, axis=0)
             self.log('IMG shift: ', self.merge_shift)
 
-        z_data = []
-        for z in range(num_slices):
+        def warp_slice(z):
             fib_new = np.copy(fib_2d)
             z_reverse = num_slices - 1 - z
             fib_new[:2, 2] += z_reverse * self.z_shift
@@ -723,9 +751,11 @@ class EM_ops():
             total_matrix[:2, 2] -= tf_corners.min(1)[:2]
             total_matrix[:2, 2] -= self.merge_shift.T
 
-            refined = np.copy(ndi.affine_transform(fm_data_orig[:, :, z], np.linalg.inv(total_matrix), order=1,
-                                           output_shape=self.data.shape))
-            z_data.append(refined)
+            return ndi.affine_transform(fm_data_orig[:, :, z], np.linalg.inv(total_matrix), order=1,
+                                        output_shape=self.data.shape)
+
+        z_data = parallel.pmap(warp_slice, range(num_slices))
+        refined = z_data[-1]
 
         if self.merged[idx] is None:
             self.merged[idx] = np.array(np.max(z_data, axis=0))
@@ -751,6 +781,7 @@ class EM_ops():
 
     @classmethod
     def get_transform(self, source, dest):
+        from skimage import transform as tf
         if len(source) != len(dest):
             self.print('Point length do not match')
             return
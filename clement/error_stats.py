@@ -0,0 +1,37 @@
+'''Closed-form statistics of (N, 2) correlation residuals
+
+The residuals are modelled by a single 2D gaussian. Its maximum likelihood parameters
+are the sample mean and the biased sample covariance, so no iterative fit is needed.
+'''
+
+import numpy as np
+
+
+def covariance(diff, reg_covar=1e-6):
+    ''' Mean and maximum likelihood covariance of diff, reg_covar is added to the diagonal '''
+    diff = np.asarray(diff, dtype='f8')
+    mean = diff.mean(0)
+    centered = diff - mean
+    cov = centered.T @ centered / len(diff)
+    cov.flat[::cov.shape[0] + 1] += reg_covar
+    return mean, cov
+
+
+def density(mean, cov, extent, num=50):
+    '''Gaussian density on a num x num grid over [-extent, extent]
+
+    Returned in meshgrid order (y, x) and normalized to a maximum of 1 on the grid
+    '''
+    axis = np.linspace(-extent, extent, num)
+    X, Y = np.meshgrid(axis, axis)
+    d = np.stack([X - mean[0], Y - mean[1]], axis=-1)
+    mahal = np.einsum('...i,ij,...j->...', d, np.linalg.inv(cov), d)
+    f = np.exp(-0.5 * (mahal - mahal.min()))
+    return f / f.max()
+
+
+def calc_error(diff):
+    ''' Covariance, std along x and y and the normalized density of the residuals diff '''
+    mean, cov = covariance(diff)
+    f = density(mean, cov, np.max(np.abs(diff)))
+    return cov, np.sqrt(cov[0, 0]), np.sqrt(cov[1, 1]), f
@@ -73,34 +73,47 @@ class FIBControls(BaseControls):
 
         self.show()
 
-    #@utils.wait_cursor('print')
-    def _load_mrc(self, jump=False):
+    def _load_mrc(self, jump=False, background=True):
+        file_name = self._file_name
         if not jump:
             if self._curr_folder is None:
                 self._curr_folder = os.getcwd()
-            self._file_name, _ = QtWidgets.QFileDialog.getOpenFileName(self,
-                                                                       'Select FIB data',
-                                                                       self._curr_folder,
-                                                                       '*.tif;;*tiff;;*.mrc')
-            self._curr_folder = os.path.dirname(self._file_name)
-
-        if self._file_name != '':
-            if self.ops is not None:
-                self.reset_init()
-            self.mrc_fname.setText(os.path.basename(self._file_name))
-
-            self.ops = EM_ops(self.print, self.log)
-            self.ops.parse_2d(self._file_name)
-            self.imview.setImage(self.ops.data)
-            self.grid_box = None
-            self.transp_btn.setEnabled(True)
-            self.sigma_btn.setEnabled(True)
-            if self.sem_ops is not None and self.sem_ops._orig_points is not None:
-                self.show_grid_btn.setEnabled(True)
-            self.show_grid_btn.setChecked(False)
+            file_name, _ = QtWidgets.QFileDialog.getOpenFileName(self,
+                                                           'Select FIB data',
+                                                           self._curr_folder,
+                                                           '*.tif;;*tiff;;*.mrc')
+            self._curr_folder = os.path.dirname(file_name)
+
+        if file_name != '':
+            self.mrc_fname.setText(os.path.basename(file_name))
+
+            def load(task):
+                ops = EM_ops(task.print, task.log)
+                ops.parse_2d(file_name)
+                return ops
+
+            self._start_loader(load, lambda ops: self._mrc_loaded(file_name, ops), 'Loading', background)
         else:
             self.print('You have to choose a file first!')
 
+    @utils.wait_cursor('print')
+    def _mrc_loaded(self, file_name, ops):
+        # The current view is only reset once the new file has been read
+        if self.ops is not None:
+            self.reset_init()
+        self._file_name = file_name
+        ops.print = self.print
+        ops.log = self.log
+        self.ops = ops
+        self.imview.getImageItem().set_pyramid(self.ops.get_pyramid())
+        self.imview.setImage(self.ops.data)
+        self.grid_box = None
+        self.transp_btn.setEnabled(True)
+        self.sigma_btn.setEnabled(True)
+        if self.sem_ops is not None and self.sem_ops._orig_points is not None:
+            self.show_grid_btn.setEnabled(True)
+        self.show_grid_btn.setChecked(False)
+
     @utils.wait_cursor('print')
     def _update_imview(self, state=None):
         if self.ops is not None and self.ops.data is not None:
@@ -109,6 +122,7 @@ class FIBControls(BaseControls):
             if old_shape == new_shape:
                 vr = self.imview.getImageItem().getViewBox().targetRect()
             levels = self.imview.getHistogramWidget().item.getLevels()
+            self.imview.getImageItem().set_pyramid(self.ops.get_pyramid())
             self.imview.setImage(self.ops.data, levels=levels)
             if old_shape == new_shape:
                 self.imview.getImageItem().getViewBox().setRange(vr, padding=0)
@@ -201,6 +215,8 @@ class FIBControls(BaseControls):
 
     @utils.wait_cursor('print')
     def reset_init(self, state=None):
+        if self.ops is not None:
+            self.ops.close()
         if self.show_grid_btn.isChecked() and self.grid_box is not None:
             self.imview.removeItem(self.grid_box)
         self.show_peaks_btn.setChecked(False)
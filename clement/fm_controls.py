@@ -3,7 +3,6 @@ import numpy as np
 from PyQt5 import QtWidgets, QtGui, QtCore
 import pyqtgraph as pg
 
-from skimage.color import hsv2rgb
 
 from .base_controls import BaseControls
 from .fm_operations import FM_ops
@@ -59,6 +58,8 @@ class FMControls(BaseControls):
         self._series = None
         self._current_slice = 0
         self._peaks = []
+        # Decoded FM volumes are stored below this folder, the system temp folder if None
+        self.scratch_folder = None
         self._bead_size = None
 
         self.print = printer
@@ -78,6 +79,10 @@ class FMControls(BaseControls):
         line.addWidget(button)
         self.fm_fname = QtWidgets.QLabel(self)
         line.addWidget(self.fm_fname, stretch=1)
+        self.cancel_load_btn = QtWidgets.QPushButton('Cancel', self)
+        self.cancel_load_btn.clicked.connect(self._cancel_loader)
+        self.cancel_load_btn.setEnabled(False)
+        line.addWidget(self.cancel_load_btn)
         self.max_proj_btn = QtWidgets.QCheckBox('Max projection')
         self.max_proj_btn.stateChanged.connect(self._show_max_projection)
         self.max_proj_btn.setEnabled(False)
@@ -271,6 +276,7 @@ class FMControls(BaseControls):
 
     @utils.wait_cursor('print')
     def _update_imview(self, state=None):
+        from skimage.color import hsv2rgb
         channel_idx = None
         if self.imview.axes['t'] is not None:
             channel_idx = self.imview.timeLine.value()
@@ -301,21 +307,38 @@ class FMControls(BaseControls):
         if self._curr_folder is None:
             self._curr_folder = os.getcwd()
 
-        self._file_name, _ = QtWidgets.QFileDialog.getOpenFileName(self,
-                                                                   'Select FM file',
-                                                                   self._curr_folder,
-                                                                   '*.lif;;*.tif;;*.tiff')
-        if self._file_name != '':
+        file_name, _ = QtWidgets.QFileDialog.getOpenFileName(self,
+                                                       'Select FM file',
+                                                       self._curr_folder,
+                                                       '*.lif;;*.tif;;*.tiff')
+        if file_name != '':
+            self._parse_fm_images(file_name, reset=True)
+
+    def _parse_fm_images(self, file_name, series=None, background=True, reset=False):
+        ''' With reset, the current view is reset once the new file has been read '''
+        self.log(file_name)
+        scratch_folder = self.scratch_folder
+
+        def load(task):
+            ops = FM_ops(task.print, task.log)
+            ops.scratch_dir = scratch_folder
+            retval = ops.parse(file_name, z=0, series=series)
+            if retval is None:
+                # The max projection is shown first, so its planes are read here as well
+                ops.calc_max_proj_data(progress=task.set_progress)
+            return ops, retval
+
+        self._start_loader(load, lambda result: self._fm_images_parsed(file_name, series, reset, *result),
+                           'Reading FM planes', background)
+
+    @utils.wait_cursor('print')
+    def _fm_images_parsed(self, file_name, series, reset, ops, retval):
+        if reset:
             self.reset_init()
-            self._curr_folder = os.path.dirname(self._file_name)
+            self._file_name = file_name
+            self._curr_folder = os.path.dirname(file_name)
             self._current_slice = self.slice_select_btn.value()
-            self._parse_fm_images(self._file_name)
 
-    @utils.wait_cursor('print')
-    def _parse_fm_images(self, file_name, series=None):
-        self.log(file_name)
-        self.ops = FM_ops(self.print, self.log)
-        retval = self.ops.parse(file_name, z=0, series=series)
         if retval is not None:
             self.picker = SeriesPicker(self, retval)
             QtWidgets.QApplication.restoreOverrideCursor()
@@ -324,15 +347,18 @@ class FMControls(BaseControls):
             self._series = self.picker.current_series
             if self._series < 0:
                 self.ops = None
-                return
-            self.ops.parse(file_name, z=0, series=self._series)
-            self.print(self.ops.data.shape)
+            else:
+                self._parse_fm_images(file_name, series=self._series)
+            return
+
+        ops.print = self.print
+        ops.log = self.log
+        self.ops = ops
+        self.print(self.ops.data.shape)
 
         self.num_slices = self.ops.num_slices
         if file_name != '':
-            if self.picker is not None:
-                self.fm_fname.setText('File: ' + os.path.basename(file_name) + '; Series: ' + retval[self.picker.current_series]  + '; Slice ' + '[0/%d]' % self.num_slices)
-            elif self.picker is None and series is not None:
+            if series is not None:
                 series_name = self.ops.base_reader.getSeries()[series].getName()
                 self.fm_fname.setText('File: ' + os.path.basename(file_name) + '; Series: ' + series_name + '; Slice ' + '[0/%d]' % self.num_slices)
             else:
@@ -1,11 +1,12 @@
 import sys
 import numpy as np
-from scipy import ndimage as ndi
-from scipy import interpolate
-from skimage import transform as tf
-from skimage import measure, morphology, io, feature
-import read_lif
+from .lif_reader import LIF_planes
+from .fm_volume import FM_volume
+from .affine_warp import Affine_warp
+from .display_cache import Display_cache
 from .ransac import Ransac
+from . import parallel
+from . import point_transforms
 from .peak_finding import Peak_finding
 
 
@@ -27,6 +28,9 @@ class FM_ops(Peak_finding):
 
         self.base_reader = None
         self.reader = None
+        self.planes = None
+        self.volume = None
+        self.scratch_dir = None  # Set by the controls, FM_volume uses the system temp folder if None
         self.voxel_size = None
         self.tif_data = None
         self.orig_data = None
@@ -54,6 +58,8 @@ class FM_ops(Peak_finding):
         self.shift = []
         self.transform_shift = 0
         self.tf_matrix = np.identity(3)
+        self.warp = Affine_warp()
+        self.display_cache = Display_cache()
         self.tf_max_proj_data = None
         self.cmap = None
         self.hsv_map = None
@@ -71,6 +77,8 @@ class FM_ops(Peak_finding):
         Saves parsed file in self.orig_data
         self.data is the array to be displayed
         '''
+        from skimage import io
+        import read_lif
         if '.tif' in fname or '.tiff' in fname:
             self.tif_data = np.array(io.imread(fname)).astype('f4')
             self.num_slices = self.tif_data.shape[0]
@@ -82,7 +90,7 @@ class FM_ops(Peak_finding):
                                           (self.orig_data[:,:,:,i].max() - self.orig_data[:,:,:,i].min())
                 self.orig_data[:,:,:,i] *= self.norm_factor
                 self.log(self.orig_data.shape)
-            self.data = np.copy(self.orig_data)
+            self.data = self.orig_data
             self.old_fname = fname
             self.selected_slice = z
         else:
@@ -95,24 +103,25 @@ class FM_ops(Peak_finding):
                 else:
                     return [s.getName() for s in self.base_reader.getSeries()]
 
-                self.num_slices = self.reader.getFrameShape()[0]
-                self.num_channels = len(self.reader.getChannels())
+                self.planes = LIF_planes(self.reader)
+                if self.volume is not None:
+                    self.volume.close()
+                self.volume = FM_volume(self.planes, self.scratch_dir)
+                self.num_slices = self.planes.num_slices
+                self.num_channels = self.planes.num_channels
                 md = self.reader.getMetadata()
                 self.voxel_size = np.array([md['voxel_size_x'], md['voxel_size_y'], md['voxel_size_z']]) * 1e-6
                 self.print('Voxel size: ', self.voxel_size)
                 self.old_fname = fname
 
-            # TODO: Look into modifying read_lif to get
-            # a single Z-slice with all channels rather than all slices for a single channel
-            self.orig_data = np.array([self.reader.getFrame(channel=i, dtype='u2')[z, :, :].astype('f4')
-                                       for i in range(self.num_channels)])
-            self.orig_data = self.orig_data.transpose(2, 1, 0)
+            # Only read the planes of slice z, not the full stack of every channel
+            self.orig_data = self.volume.get_slice(z).astype('f4').transpose(2, 1, 0)
             #normalize to 100
             for i in range(self.orig_data.shape[-1]):
                 self.orig_data[:, :, i] = (self.orig_data[:, :, i] - self.orig_data[:, :, i].min()) / \
                                              (self.orig_data[:, :, i].max() - self.orig_data[:, :, i].min())
                 self.orig_data[:,:,i] *= self.norm_factor
-            self.data = np.copy(self.orig_data)
+            self.data = self.orig_data
             self.selected_slice = z
             [self._aligned_channels.append(False) for i in range(self.num_channels)]
             [self._color_matrices.append(np.identity(3)) for i in range(self.num_channels)]
@@ -122,32 +131,41 @@ class FM_ops(Peak_finding):
             self._update_data()
 
     def _update_data(self, update=True, update_points=True):
+        # self.data is never modified in place, so it refers to the source arrays (or cached
+        # derived arrays) directly and the flips below are zero-copy views of them
+        source = None
         if self._transformed and (
                 self.tf_data is not None or self.tf_max_proj_data is not None or self.tf_hsv_map is not None or self.tf_hsv_map_no_tilt is not None):
             if self._show_mapping:
                 if self._show_no_tilt:
-                    self.data = np.copy(self.tf_hsv_map_no_tilt)
+                    self.data = self.tf_hsv_map_no_tilt
                 else:
-                    self.data = np.copy(self.tf_hsv_map)
+                    self.data = self.tf_hsv_map
             elif self._show_max_proj:
-                self.data = np.copy(self.tf_max_proj_data)
+                self.data = self.tf_max_proj_data
+                source = self.max_proj_data
             else:
-                self.data = np.copy(self.tf_data)
+                self.data = self.tf_data
+                source = self.orig_data
             self.points = np.copy(self._tf_points)
         else:
             if self._show_mapping and self.hsv_map is not None:
                 if self._show_no_tilt:
-                    self.data = np.copy(self.hsv_map_no_tilt)
+                    self.data = self.hsv_map_no_tilt
                 else:
-                    self.data = np.copy(self.hsv_map)
+                    self.data = self.hsv_map
             elif self._show_max_proj and self.max_proj_data is not None:
-                self.data = np.copy(self.max_proj_data)
+                self.data = self.max_proj_data
             else:
-                self.data = np.copy(self.orig_data)
+                self.data = self.orig_data
             self.points = np.copy(self._orig_points) if self._orig_points is not None else None
 
         if True in self._aligned_channels and not self._show_mapping:
-            self.apply_alignment()
+            tf_key = Display_cache.hash_matrix(self.tf_matrix) if self._transformed else None
+            key = ('aligned', tf_key, tuple(self._aligned_channels),
+                   tuple(Display_cache.hash_matrix(m) for m in self._color_matrices))
+            self.data = self.display_cache.get_or_compute(self.data, key,
+                                                          lambda: self.apply_alignment(self.data, source))
 
         if update:
             if self._transformed:
@@ -250,13 +268,19 @@ class FM_ops(Peak_finding):
                 self.apply_transform()
         self._update_data()
 
-    def calc_max_proj_data(self):
+    def calc_max_proj_data(self, progress=None):
+        ''' progress(done, total) is called after every plane that is read, if given '''
         if self.reader is None:
             self.max_proj_data = self.tif_data.max(0)
             #self.max_proj_data /= self.max_proj_data.mean((0, 1))
         else:
-            self.max_proj_data = np.array([self.reader.getFrame(channel=i, dtype='u2').max(0)
-                                           for i in range(self.num_channels)]).transpose(2, 1, 0).astype('f4')
+            projections = []
+            for i in range(self.num_channels):
+                channel_progress = None
+                if progress is not None:
+                    channel_progress = lambda z, num, i=i: progress(i * num + z, self.num_channels * num)
+                projections.append(self.volume.calc_projections(i, progress=channel_progress)[0])
+            self.max_proj_data = np.array(projections).transpose(2, 1, 0).astype('f4')
             #self.max_proj_data /= self.max_proj_data.mean((0, 1))
             for i in range(self.num_channels):
                 self.max_proj_data[:,:,i] = (self.max_proj_data[:,:,i] - self.max_proj_data[:,:,i].min()) / \
@@ -275,6 +299,7 @@ class FM_ops(Peak_finding):
         return hsv
 
     def create_cmaps(self, rot=0.):
+        from scipy import interpolate
         points = np.array([[0, 0], [1, 0], [0, 0.5], [1, 0.5], [0, 1], [1, 1]])
         hue = (points[:, 1] * 1.5 + 3) / 6. + rot
         sat = np.array([1., 1., 1. / 3, 1. / 3, 1., 1.])
@@ -289,7 +314,7 @@ class FM_ops(Peak_finding):
         if self.hsv_map is None:
             if self.max_proj_data is None:
                 self.calc_max_proj_data()
-            argmax_map = np.argmax(self.reader.getFrame(channel=self._channel_idx, dtype='u2'), axis=0).astype('f4').transpose((1, 0))
+            argmax_map = self.volume.calc_projections(self._channel_idx)[1].astype('f4').transpose((1, 0))
             self.cmap = self.create_cmaps(rot=1. / 2)
             self.hsv_map = self.colorize2d(self.max_proj_data[:, :, self._channel_idx], argmax_map, self.cmap)
 
@@ -304,7 +329,7 @@ class FM_ops(Peak_finding):
         if self.hsv_map_no_tilt is None:
             if self.peak_slices is None or self.peak_slices[-1] is None:
                 self.peak_finding(self.max_proj_data[:, :, self._channel_idx], transformed=False)
-            ref = np.array(self.reader.getFrame(channel=self._channel_idx, dtype='u2').astype('f4')).transpose((2, 1, 0))
+            ref = self.volume.get_view(self._channel_idx)
             if self.peaks_z is None:
                 self.fit_z(ref, transformed=False)
             # fit plane to peaks with least squares to remove tilt
@@ -317,7 +342,7 @@ class FM_ops(Peak_finding):
             d = -point.dot(normal)  # distance to origin
             x, y = np.indices((2048, 2048))
             z_plane = -(normal[0] * x + normal[1] * y + d) / normal[2]  # z values of plane for whole image
-            z_max_all = np.argmax(ref, axis=2)
+            z_max_all = self.volume.calc_projections(self._channel_idx)[1].transpose((1, 0))
 
             argmax_map_no_tilt = z_max_all - z_plane
             self.hsv_map_no_tilt = self.colorize2d(self.max_proj_data[:, :, self._channel_idx], argmax_map_no_tilt, self.cmap)
@@ -340,13 +365,13 @@ class FM_ops(Peak_finding):
                 self.print('Index not found. Calculate local z position!')
                 flip_list = [self.transp, self.rot, self.fliph, self.flipv]
                 point = np.array((pos[0], pos[1]))
-                tf_aligned = self.tf_matrix @ self._color_matrices[channel]
+                tf_aligned = point_transforms.compose(self.tf_matrix, self._color_matrices[channel])
                 z = self.calc_local_z(self.channel, point, transformed, tf_aligned, flip_list, self.data.shape[:-1])
         else:
             if ind is not None:
                 z = self.peaks_z[ind]
             else:
-                point = np.linalg.inv(self._color_matrices[channel]) @ np.array([pos[0], pos[1], 1])
+                point = point_transforms.apply(point_transforms.inverse(self._color_matrices[channel]), pos[:2])
                 z = self.calc_local_z(self.channel, point, transformed)
         if z is None:
             self.print('Oops, something went wrong. Try somewhere else!')
@@ -358,9 +383,10 @@ class FM_ops(Peak_finding):
         return z
 
     def load_channel(self, ind):
-        self.channel = np.array(self.reader.getFrame(channel=ind, dtype='u2').astype('f4')).transpose((2, 1, 0))
-        self.channel = (self.channel - self.channel.min()) / (self.channel.max() - self.channel.min())
-        self.channel *= self.norm_factor
+        self.channel = self.volume.get_view(ind).astype('f4')
+        ch_min, ch_max = self.channel.min(), self.channel.max()
+        self.channel -= ch_min
+        self.channel *= self.norm_factor / (ch_max - ch_min)
         self._channel_idx = ind
         self.print('Load channel {}'.format(ind+1))
 
@@ -369,6 +395,7 @@ class FM_ops(Peak_finding):
         self.channel = None
 
     def estimate_alignment(self, peaks_2d, idx):
+        from skimage import transform as tf
         roi_size = 20
         tmp = []
         ref = []
@@ -401,16 +428,36 @@ class FM_ops(Peak_finding):
         else:
             self.print('Unable to align channels. Be sure you select a fluorescence channel!')
 
-    def apply_alignment(self):
+    def apply_alignment(self, data, source=None):
+        '''Returns a copy of data with the aligned channels shifted by their color matrices
+
+        If source is the untransformed array that data was warped from, the aligned channels
+        are resampled once from source through tf_matrix @ color_matrix, instead of warping
+        the already transformed (and interpolated) channel a second time.
+        '''
+        from scipy import ndimage as ndi
+        aligned = np.array(data)
         for i in range(self.num_channels):
-            if self._aligned_channels[i]:
-                if self._transformed:
-                    color_matrix = self.tf_matrix @ self._color_matrices[i] @ np.linalg.inv(self.tf_matrix)
-                else:
-                    color_matrix = self._color_matrices[i]
-                self.log(color_matrix)
-                self.data[:,:,i] = np.copy(ndi.affine_transform(self.data[:, :, i], np.linalg.inv(color_matrix), order=1))
+            if not self._aligned_channels[i]:
+                continue
+            if self._transformed and source is not None:
+                total_matrix = point_transforms.compose(self.tf_matrix, self._color_matrices[i])
+                self.log(total_matrix)
+                ndi.affine_transform(source[:, :, i], point_transforms.inverse(total_matrix), order=1,
+                                     output_shape=data.shape[:2], output=aligned[:, :, i])
+                continue
+            if self._transformed:
+                color_matrix = point_transforms.compose(self.tf_matrix, self._color_matrices[i],
+                                                        point_transforms.inverse(self.tf_matrix))
+            else:
+                color_matrix = self._color_matrices[i]
+            self.log(color_matrix)
+            ndi.affine_transform(data[:, :, i], point_transforms.inverse(color_matrix), order=1,
+                                 output=aligned[:, :, i])
+        return aligned
+
     def calc_affine_transform(self, my_points):
+        from skimage import transform as tf
         my_points = self.calc_orientation(my_points)
         self.log('Input points:\n', my_points)
 
@@ -520,55 +567,33 @@ class FM_ops(Peak_finding):
 
         if self._show_mapping:
             if self._show_no_tilt:
-                self.tf_hsv_map_no_tilt = np.empty(self._tf_shape + (self.hsv_map_no_tilt.shape[-1],))
-                for i in range(self.tf_hsv_map_no_tilt.shape[-1]):
-                    self.tf_hsv_map_no_tilt[:, :, i] = ndi.affine_transform(self.hsv_map_no_tilt[:, :, i],
-                                                                            np.linalg.inv(self.tf_matrix), order=1,
-                                                                            output_shape=self._tf_shape)
-                    sys.stderr.write('\r%d' % i)
+                self.tf_hsv_map_no_tilt = self.warp.warp(self.hsv_map_no_tilt, self.tf_matrix, self._tf_shape,
+                                                         name='hsv_map_no_tilt')
                 self._update_data(update_points=False)
                 self.log(self.tf_hsv_map_no_tilt.shape)
 
             else:
-                self.tf_hsv_map = np.empty(self._tf_shape + (self.hsv_map.shape[-1],))
-                for i in range(self.tf_hsv_map.shape[-1]):
-                    self.tf_hsv_map[:, :, i] = ndi.affine_transform(self.hsv_map[:, :, i],
-                                                                    np.linalg.inv(self.tf_matrix), order=1,
-                                                                    output_shape=self._tf_shape)
-                    sys.stderr.write('\r%d' % i)
+                self.tf_hsv_map = self.warp.warp(self.hsv_map, self.tf_matrix, self._tf_shape, name='hsv_map')
                 self._update_data(update_points=False)
             if shift_points and not self._transformed:
                 self._tf_points = np.array([point + self.transform_shift for point in self._tf_points])
         else:
             if not self._show_max_proj and self.max_proj_data is None:
                 # If max_projection has not yet been selected
-                self.tf_data = np.empty(self._tf_shape + (self.data.shape[-1],))
-                for i in range(self.data.shape[-1]):
-                    self.tf_data[:, :, i] = ndi.affine_transform(self.orig_data[:, :, i], np.linalg.inv(self.tf_matrix),
-                                                                 order=1, output_shape=self._tf_shape)
-                    sys.stderr.write('\r%d' % i)
+                self.tf_data = self.warp.warp(self.orig_data, self.tf_matrix, self._tf_shape, name='data')
                 self.log('\n', self.tf_data.shape)
                 if shift_points:
                     self._tf_points = np.array([point + self.transform_shift for point in self._tf_points])
             elif self._show_max_proj and self._transformed:
                 # If showing max_projection with image already transformed (???)
-                self.tf_max_proj_data = np.empty(self._tf_shape + (self.data.shape[-1],))
-                for i in range(self.data.shape[-1]):
-                    self.tf_max_proj_data[:, :, i] = ndi.affine_transform(self.max_proj_data[:, :, i],
-                                                                          np.linalg.inv(self.tf_matrix), order=1,
-                                                                          output_shape=self._tf_shape)
-                    sys.stderr.write('\r%d' % i)
+                self.tf_max_proj_data = self.warp.warp(self.max_proj_data, self.tf_matrix, self._tf_shape,
+                                                       name='max_proj_data')
                 self._update_data(update_points=False)
             else:
-                self.tf_data = np.empty(self._tf_shape + (self.data.shape[-1],))
-                self.tf_max_proj_data = np.empty(self._tf_shape + (self.data.shape[-1],))
-                for i in range(self.data.shape[-1]):
-                    self.tf_data[:, :, i] = ndi.affine_transform(self.orig_data[:, :, i], np.linalg.inv(self.tf_matrix),
-                                                                 order=1, output_shape=self._tf_shape)
-                    self.tf_max_proj_data[:, :, i] = ndi.affine_transform(self.max_proj_data[:, :, i],
-                                                                          np.linalg.inv(self.tf_matrix), order=1,
-                                                                          output_shape=self._tf_shape)
-                    sys.stderr.write('\r%d' % i)
+                # Sources that did not change since the last call are not warped again
+                self.tf_data = self.warp.warp(self.orig_data, self.tf_matrix, self._tf_shape, name='data')
+                self.tf_max_proj_data = self.warp.warp(self.max_proj_data, self.tf_matrix, self._tf_shape,
+                                                       name='max_proj_data')
                 self.log('\n', self.tf_data.shape)
                 self.log(self.max_proj_data.shape)
                 if shift_points:
@@ -588,6 +613,7 @@ class FM_ops(Peak_finding):
         self._update_data()
 
     def optimize(self, fm_max, em_img, fm_points, em_points):
+        from scipy import ndimage as ndi
         def preprocessing(img, points, size=15, em=False):
             roi = img[points[0] - size:points[0] + size, points[1] - size:points[1] + size]
             if em:
@@ -619,14 +645,20 @@ class FM_ops(Peak_finding):
 
         return fm_coor_list, em_coor_list
 
-    def fit_circles(self, points, bead_size):
-        points_model = []
-        successfull = False
+    def fit_circles(self, points, bead_size, refit=False):
+        '''Refines the bead centers at points by RANSAC circle fits to the edges around them
+
+        With refit, the best circle is refined by a least-squares fit to its inliers. Returns
+        the centers and a boolean array marking the beads that were fitted, the others keep
+        their original coordinate.
+        '''
+        from skimage import feature
         roi_size = int(
             np.round(bead_size * 1e-6 / self.voxel_size[0] + bead_size * 1e-6 / (2 * self.voxel_size[0])) / 2)
-        for i in range(len(points)):
-            x = int(np.round(points[i, 0]))
-            y = int(np.round(points[i, 1]))
+
+        def fit_bead(point):
+            x = int(np.round(point[0]))
+            y = int(np.round(point[1]))
             x_min = (x - roi_size) if (x - roi_size) > 0 else 0
             x_max = (x + roi_size) if (x + roi_size) < self.data.shape[0] else self.data.shape[0]
             y_min = (y - roi_size) if (y - roi_size) > 0 else 0
@@ -637,33 +669,26 @@ class FM_ops(Peak_finding):
             coor_x, coor_y = np.where(edges != 0)
             if len(coor_x) != 0:
                 rad = bead_size * 1e-6 / self.voxel_size[0] / 2  # bead size is supposed to be in microns
-                ransac = Ransac(coor_x, coor_y, 100, rad)
-                counter = 0
-                while True:
-                    try:
-                        ransac.run()
-                        successfull = True
-                        break
-                    except np.linalg.LinAlgError:
-                        counter += 1
-                        if counter % 1 == 0:
-                            self.log('\rLinAlgError: ', counter)
-                        if counter == 100:
-                            break
-            if successfull:
-                if ransac.best_fit is not None:  # This should not happen, but it happens sometimes...
+                ransac = Ransac(coor_x, coor_y, 100, rad, refit=refit)
+                ransac.run()
+                # best_fit stays None if all sampled triples were collinear
+                if ransac.best_fit is not None:
                     cx, cy = ransac.best_fit[0], ransac.best_fit[1]
-                    coor = np.array([cx, cy]) + np.array([x, y]).T - np.array([roi_size, roi_size])
-                    points_model.append(coor)
-                # else:
-                #    self.print('Unable to fit bead #{}! Used original coordinate instead!'.format(i))
-                #    points_model.append(np.array([x, y]))
-            else:
+                    return np.array([cx, cy]) + np.array([x, y]).T - np.array([roi_size, roi_size]), True
+            return np.array([x, y]), False
+
+        # Beads are fitted on the shared pool, messages are printed afterwards from this thread
+        points_model = []
+        fitted = []
+        for i, (coor, successfull) in enumerate(parallel.pmap(fit_bead, points)):
+            if not successfull:
                 self.print('Unable to fit bead #{}! Used original coordinate instead!'.format(i))
-                points_model.append(np.array([x, y]))
-        return np.array(points_model)
+            points_model.append(coor)
+            fitted.append(successfull)
+        return np.array(points_model), np.array(fitted, dtype=bool)
 
     def update_fm_sem_matrix(self, tr_matrix, flips):
+        from skimage import transform as tf
         points = np.copy(self._tf_points)
         transp, rot, fliph, flipv = self.transp, self.rot, self.fliph, self.flipv
         if 0 in flips:
@@ -690,6 +715,7 @@ class FM_ops(Peak_finding):
         return tr_matrix @ rot_matrix
 
     def get_transform(self, source, dest):
+        from skimage import transform as tf
         if len(source) != len(dest):
             self.print('Point length do not match')
             return
@@ -0,0 +1,94 @@
+import os
+import shutil
+import tempfile
+import weakref
+import numpy as np
+
+
+class FM_volume():
+    '''Per-series cache of the raw FM channels
+
+    Each channel is decoded only once, plane by plane, into a uint16 memory-mapped
+    (Z, Y, X) file in a scratch directory. Consumers get views of these maps, so
+    repeated operations neither decode the LIF again nor keep float copies around.
+    The scratch directory is removed when the volume is closed or garbage collected.
+    '''
+    def __init__(self, planes, scratch_dir=None):
+        self.planes = planes
+        self.num_channels = planes.num_channels
+        self.num_slices = planes.num_slices
+        self.dtype = planes.dtype
+        self.shape = (planes.num_slices, planes.ny, planes.nx)
+
+        if scratch_dir is not None:
+            os.makedirs(scratch_dir, exist_ok=True)
+        self.scratch_dir = tempfile.mkdtemp(prefix='clement_fm_', dir=scratch_dir)
+        self._channels = [None] * self.num_channels
+        self._projections = [None] * self.num_channels
+        self._cleanup = weakref.finalize(self, shutil.rmtree, self.scratch_dir, True)
+
+    def is_cached(self, channel):
+        return self._channels[channel] is not None
+
+    def get_channel(self, channel):
+        ''' Returns read-only (Z, Y, X) memory map of a channel, decoding it on first access '''
+        if self._channels[channel] is None:
+            fname = os.path.join(self.scratch_dir, 'channel_%d.u2' % channel)
+            vol = np.memmap(fname, dtype=self.dtype, mode='w+', shape=self.shape)
+            for z in range(self.num_slices):
+                vol[z] = self.planes.get_plane(channel, z)
+            vol.flush()
+            del vol
+            self._channels[channel] = np.memmap(fname, dtype=self.dtype, mode='r', shape=self.shape)
+        return self._channels[channel]
+
+    def get_view(self, channel):
+        ''' Returns (X, Y, Z) view of a channel, the axis order used throughout FM_ops '''
+        return self.get_channel(channel).transpose(2, 1, 0)
+
+    def get_plane(self, channel, z):
+        ''' Returns (Y, X) plane, from the cache if the channel is already decoded '''
+        if self.is_cached(channel):
+            return self._channels[channel][z]
+        return self.planes.get_plane(channel, z)
+
+    def calc_projections(self, channel, calc_mean=False, calc_sum=False, progress=None):
+        '''Single streaming pass over the planes of a channel
+
+        Returns (Y, X) max projection and argmax-z map, followed by the mean and sum
+        projections (None unless requested). Only the accumulators and the current
+        plane are held in memory. Results are cached per channel, the mean is derived
+        from the cached sum, so the planes are only read again if a sum is requested
+        for the first time.
+        progress(done, total) is called after every plane if given.
+        '''
+        want_sum = calc_mean or calc_sum
+        cached = self._projections[channel]
+        if cached is None or (want_sum and cached[2] is None):
+            max_proj = np.array(self.get_plane(channel, 0))
+            argmax_z = np.zeros(max_proj.shape, dtype='i4')
+            sum_proj = max_proj.astype('f8') if want_sum else None
+            for z in range(1, self.num_slices):
+                plane = self.get_plane(channel, z)
+                # strict comparison keeps the first maximum, as np.argmax does
+                mask = plane > max_proj
+                max_proj[mask] = plane[mask]
+                argmax_z[mask] = z
+                if sum_proj is not None:
+                    sum_proj += plane
+                if progress is not None:
+                    progress(z + 1, self.num_slices)
+            cached = self._projections[channel] = (max_proj, argmax_z, sum_proj)
+
+        max_proj, argmax_z, sum_proj = cached
+        mean_proj = sum_proj / self.num_slices if calc_mean else None
+        return max_proj, argmax_z, mean_proj, sum_proj if calc_sum else None
+
+    def get_slice(self, z):
+        ''' Returns (num_channels, Y, X) array of slice z, from the cache where available '''
+        return np.array([self.get_plane(c, z) for c in range(self.num_channels)])
+
+    def close(self):
+        self._channels = [None] * self.num_channels
+        self._projections = [None] * self.num_channels
+        self._cleanup()
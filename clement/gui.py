@@ -5,14 +5,14 @@ import warnings
 from PyQt5 import QtCore, QtGui, QtWidgets
 import pyqtgraph as pg
 
-from . import res_styles
 from .sem_controls import SEMControls
 from .tem_controls import TEMControls
 from .fm_controls import FMControls
 from .fib_controls import FIBControls
+from .base_controls import TiledImageView
 from .project import Project
-from .popup import Merge, Scatter, Convergence, Peak_Params
 from . import utils
+from . import parallel
 
 warnings.simplefilter('ignore', category=FutureWarning)
 
@@ -32,6 +32,7 @@ class GUI(QtWidgets.QMainWindow):
         else:
             self.settings = QtCore.QSettings()
         self.colors = self.settings.value('channel_colors', defaultValue=['#ff0000', '#00ff00', '#0000ff', '#808080', '#808080'])
+        parallel.set_num_workers(self.settings.value('num_threads', defaultValue=0, type=int))
         self._init_ui()
         if project_fname is not None:
             self.project._load_project(project_fname)
@@ -56,7 +57,7 @@ class GUI(QtWidgets.QMainWindow):
         # -- FM Image view
         # self.fm_imview = pg.ImageView()
         self.fm_stacked_imview = QtWidgets.QStackedWidget()
-        self.fm_imview = pg.ImageView()
+        self.fm_imview = TiledImageView()
         self.fm_imview.ui.roiBtn.hide()
         self.fm_imview.ui.menuBtn.hide()
         self.fm_stacked_imview.addWidget(self.fm_imview)
@@ -65,13 +66,13 @@ class GUI(QtWidgets.QMainWindow):
 
         # -- EM Image view
         self.em_imview = QtWidgets.QStackedWidget()
-        self.sem_imview = pg.ImageView()
+        self.sem_imview = TiledImageView()
         self.sem_imview.ui.roiBtn.hide()
         self.sem_imview.ui.menuBtn.hide()
-        self.fib_imview = pg.ImageView()
+        self.fib_imview = TiledImageView()
         self.fib_imview.ui.roiBtn.hide()
         self.fib_imview.ui.menuBtn.hide()
-        self.tem_imview = pg.ImageView()
+        self.tem_imview = TiledImageView()
         self.tem_imview.ui.roiBtn.hide()
         self.tem_imview.ui.menuBtn.hide()
         self.em_imview.addWidget(self.sem_imview)
@@ -159,6 +160,8 @@ class GUI(QtWidgets.QMainWindow):
         self.peak_params = None
         self.project = Project(self.fm_controls, self.sem_controls, self.fib_controls, self.tem_controls, self, self.print, self.log)
         self.project._project_folder = self.settings.value('project_folder', defaultValue=os.getcwd())
+        self.fm_controls.scratch_folder = self.settings.value('scratch_folder',
+                                                              defaultValue=self.project.scratch_folder())
         # Menu Bar
         self._init_menubar()
 
@@ -239,7 +242,11 @@ class GUI(QtWidgets.QMainWindow):
 
     @utils.wait_cursor('print')
     def _show_scatter(self, idx):
+        from .popup import Scatter
         self.scatter = None
+        if self.fm_controls.is_estimating(idx):
+            self.print('Precision estimate is still running, try again in a moment!')
+            return
         if self.fm_controls.other._err[idx] is None:
             return
         if idx == 0:
@@ -254,7 +261,11 @@ class GUI(QtWidgets.QMainWindow):
 
     @utils.wait_cursor('print')
     def _show_convergence(self, idx):
+        from .popup import Convergence
         self.convergence = None
+        if self.fm_controls.is_estimating(idx):
+            self.print('Precision estimate is still running, try again in a moment!')
+            return
         if self.fm_controls.other._conv[idx] is None:
             return
         if len(self.fm_controls.other._conv[idx]) == 3:
@@ -272,6 +283,7 @@ class GUI(QtWidgets.QMainWindow):
 
     @utils.wait_cursor('print')
     def _show_peak_params(self, state=None):
+        from .popup import Peak_Params
         self.fm_controls.peak_btn.setChecked(False)
         if self.peak_params is None:
             self.peak_params = Peak_Params(self, self.fm_controls, self.print, self.log)
@@ -280,6 +292,7 @@ class GUI(QtWidgets.QMainWindow):
 
     @utils.wait_cursor('print')
     def merge(self, project=None):
+        from .popup import Merge
         self.fm = self.fm_controls.ops
         self.em = self.fm_controls.other.ops
         if self.tabs.currentIndex() == 0:
@@ -322,6 +335,9 @@ class GUI(QtWidgets.QMainWindow):
     @utils.wait_cursor('print')
     def _set_theme(self, name):
         self.setStyleSheet('')
+        if name != 'none':
+            # Registers the Qt resources the dark and solarized stylesheets refer to
+            from . import res_styles
         with open(resource_path('styles/%s.qss' % name), 'r') as f:
             self.setStyleSheet(f.read())
 
@@ -362,6 +378,7 @@ class GUI(QtWidgets.QMainWindow):
         self.settings.setValue('tem_folder', self.tem_controls._curr_folder)
         self.settings.setValue('fib_folder', self.fib_controls._curr_folder)
         self.settings.setValue('project_folder', self.project._project_folder)
+        self.settings.setValue('scratch_folder', self.fm_controls.scratch_folder)
         event.accept()
 
 
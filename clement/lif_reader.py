@@ -0,0 +1,41 @@
+import numpy as np
+
+
+class LIF_planes():
+    '''Lazy single-plane access to a read_lif Serie
+
+    read_lif only offers getFrame(), which decodes the whole Z-stack of one channel.
+    Here the byte offset of every (z, channel) plane is computed once from the series
+    header and planes are read straight from a read-only memory map of the file,
+    so only the bytes of the requested plane are touched.
+    '''
+    def __init__(self, serie, dtype='u2'):
+        self.serie = serie
+        self.dtype = np.dtype(dtype)
+        self.num_slices, self.ny, self.nx = serie.getFrameShape()
+        self.num_channels = len(serie.getChannels())
+        self.plane_size = int(self.nx * self.ny) * self.dtype.itemsize
+
+        self.offsets = np.zeros((self.num_slices, self.num_channels), dtype='i8')
+        for c in range(self.num_channels):
+            channel_offset = serie.getChannelOffset(c)
+            for z in range(self.num_slices):
+                self.offsets[z, c] = serie.getOffset(T=0, Z=z) + channel_offset
+        self._mmap = np.memmap(serie.f.name, dtype='u1', mode='r')
+
+    @property
+    def shape(self):
+        ''' (num_channels, num_slices, ny, nx), the C-order shape of the series '''
+        return (self.num_channels, self.num_slices, self.ny, self.nx)
+
+    def get_plane(self, channel, z):
+        ''' Returns (ny, nx) read-only view of a single plane '''
+        start = self.offsets[z, channel]
+        return self._mmap[start:start + self.plane_size].view(self.dtype).reshape(self.ny, self.nx)
+
+    def get_slice(self, z):
+        ''' Returns (num_channels, ny, nx) array of all channels in slice z '''
+        return np.array([self.get_plane(c, z) for c in range(self.num_channels)])
+
+    def close(self):
+        self._mmap = None
@@ -0,0 +1,71 @@
+'''Shared thread pool for the per-channel, per-slice and per-bead loops
+
+The number of workers is taken from the CLEMENT_NUM_THREADS environment variable,
+then from set_num_workers() (the GUI passes the 'num_threads' setting), and
+falls back to the number of CPUs. The heavy kernels (scipy.ndimage, skimage)
+release the GIL, so threads are enough here.
+'''
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+_num_workers = None
+_executor = None
+_lock = threading.Lock()
+_local = threading.local()
+
+
+def get_num_workers():
+    env = os.environ.get('CLEMENT_NUM_THREADS')
+    if env is not None and env.strip().isdigit() and int(env) > 0:
+        return int(env)
+    if _num_workers is not None and _num_workers > 0:
+        return _num_workers
+    return os.cpu_count() or 1
+
+
+def set_num_workers(num):
+    ''' Sets the pool size, 0 or None selects the number of CPUs '''
+    global _num_workers, _executor
+    with _lock:
+        _num_workers = int(num) if num else None
+        if _executor is not None:
+            _executor.shutdown(wait=False)
+            _executor = None
+
+
+def get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=get_num_workers(), thread_name_prefix='clement',
+                                           initializer=_mark_worker)
+        return _executor
+
+
+def _mark_worker():
+    _local.in_pool = True
+
+
+def pmap(func, *iterables, progress=None):
+    '''Parallel map over the shared pool
+
+    Results are returned as a list in the order of the inputs. Runs serially when
+    only one worker is configured or when called from inside the pool itself, so
+    nested calls cannot deadlock. progress(done, total) is called from the calling
+    thread whenever an item is finished.
+    '''
+    args = list(zip(*iterables))
+    if len(args) <= 1 or get_num_workers() == 1 or getattr(_local, 'in_pool', False):
+        results = []
+        for a in args:
+            results.append(func(*a))
+            if progress is not None:
+                progress(len(results), len(args))
+        return results
+    futures = [get_executor().submit(func, *a) for a in args]
+    if progress is not None:
+        for done, future in enumerate(as_completed(futures), 1):
+            progress(done, len(args))
+    return [future.result() for future in futures]
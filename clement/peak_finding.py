@@ -1,9 +1,6 @@
 import numpy as np
-import scipy.ndimage as ndi
-from scipy.optimize import curve_fit
 import time
-from skimage import measure, morphology
-import read_lif
+from . import point_transforms
 
 class Peak_finding():
     def __init__(self, threshold=0, plt=10, put=200):
@@ -28,9 +25,11 @@ class Peak_finding():
         self.sigma_z = None
         self.aligning = False
         self.my_counter = None
+        self._peak_trees = {}
 
 
     def peak_finding(self, im, transformed, roi=False, curr_slice=None, roi_pos=None, background_correction=None):
+        from scipy import ndimage as ndi
         start = time.time()
         if not roi:
             if transformed:
@@ -56,52 +55,23 @@ class Peak_finding():
         label_size = np.bincount(labels.ravel())
 
         # single photons and no noise
-        mask_sp = np.where((label_size >= self.pixel_lower_threshold) & (label_size < self.pixel_upper_threshold),
-                           True, False)
-        if sum(mask_sp) == 0:
+        mask_sp = (label_size >= self.pixel_lower_threshold) & (label_size < self.pixel_upper_threshold)
+        mask_sp[0] = False
+        if np.count_nonzero(mask_sp) == 0:
             coor_sp = []
         else:
-            label_mask_sp = mask_sp[labels.ravel()].reshape(labels.shape)
-            labels_sp = label_mask_sp * labels
-            labels_sp, n_s = ndi.label(labels_sp)
-            coor_sp = ndi.center_of_mass(img, labels_sp, range(1, labels_sp.max() + 1))
+            coor_sp = ndi.center_of_mass(img, labels, np.flatnonzero(mask_sp))
 
         # multiple photons
-        mask_mp = np.where((label_size >= self.pixel_upper_threshold) & (label_size < np.max(label_size)), True,
-                           False)
-        if sum(mask_mp) > 0:
-            label_mask_mp = mask_mp[labels.ravel()].reshape(labels.shape)
-            labels_mp = label_mask_mp * labels
-            labels_mp, n_m = ndi.label(labels_mp)
-            for i in range(1, sum(mask_mp) + 1):
-                objects = ndi.find_objects(labels_mp == i)
-                if len(objects) == 0:
-                    self.print('No beads found!')
-                    return None
-                slice_x, slice_y = objects[0]
-                roi_i = np.copy(img[slice_x, slice_y])
-                max_i = np.max(roi_i)
-                step = (0.95 * max_i - self.threshold) / self.flood_steps
-                multiple = False
-                coor_tmp = np.array(ndi.center_of_mass(roi_i, ndi.label(roi_i)[0]))
-                for k in range(1, self.flood_steps + 1):
-                    new_threshold = self.threshold + k * step
-                    roi_i[roi_i < new_threshold] = 0
-                    labels_roi, n_i = ndi.label(roi_i)
-                    if n_i > 1:
-                        roi_label_size = np.bincount(labels_roi.ravel())
-                        if np.max(roi_label_size[1:]) <= self.pixel_upper_threshold:
-                            if len(roi_label_size) == 3 and roi_label_size.min() < self.roi_min_size:
-                                break
-                            else:
-                                multiple = True
-                                coordinates_roi = np.array(ndi.center_of_mass(roi_i, labels_roi, range(1, n_i + 1)))
-                                [coor_sp.append(coordinates_roi[j] + np.array((slice_x.start, slice_y.start))) for j
-                                 in
-                                 range(len(coordinates_roi))]
-                                break
-                if not multiple:
-                    coor_sp.append(coor_tmp + np.array((slice_x.start, slice_y.start)))
+        mask_mp = (label_size >= self.pixel_upper_threshold) & (label_size < np.max(label_size))
+        if np.count_nonzero(mask_mp) > 0:
+            # one find_objects call for all labels instead of one full-image mask per label
+            labels_mp = mask_mp[labels] * labels
+            objects = [obj for obj in ndi.find_objects(labels_mp) if obj is not None]
+            if len(objects) == 0:
+                self.print('No beads found!')
+                return None
+            coor_sp = list(coor_sp) + self._split_objects(img, objects)
 
         coor = np.array(coor_sp)
         if len(coor) == 0:
@@ -137,7 +107,41 @@ class Peak_finding():
         self.log('duration: ', end - start)
         self.print('Number of peaks found: ', peaks_2d.shape[0])
 
+    def _split_objects(self, img, objects):
+        '''Splits large objects by flood thresholding their bounding-box crops
+
+        Returns the list of centroids, in image coordinates, in the order of objects.
+        '''
+        from scipy import ndimage as ndi
+        coor = []
+        for slice_x, slice_y in objects:
+            roi_i = np.copy(img[slice_x, slice_y])
+            origin = np.array((slice_x.start, slice_y.start))
+            max_i = np.max(roi_i)
+            step = (0.95 * max_i - self.threshold) / self.flood_steps
+            # same as the centroid over ndi.label(roi_i)[0] > 0, since the background is zero
+            coor_tmp = np.array(ndi.center_of_mass(roi_i))
+            multiple = False
+            for k in range(1, self.flood_steps + 1):
+                new_threshold = self.threshold + k * step
+                roi_i[roi_i < new_threshold] = 0
+                labels_roi, n_i = ndi.label(roi_i)
+                if n_i > 1:
+                    roi_label_size = np.bincount(labels_roi.ravel())
+                    if np.max(roi_label_size[1:]) <= self.pixel_upper_threshold:
+                        if len(roi_label_size) == 3 and roi_label_size.min() < self.roi_min_size:
+                            break
+                        else:
+                            multiple = True
+                            coordinates_roi = np.array(ndi.center_of_mass(roi_i, labels_roi, range(1, n_i + 1)))
+                            coor.extend(coordinates_roi + origin)
+                            break
+            if not multiple:
+                coor.append(coor_tmp + origin)
+        return coor
+
     def subtract_background(self, img, sigma=None):
+        from scipy import ndimage as ndi
         if sigma is None:
             sigma = self.sigma_background
         norm = img.max()
@@ -147,6 +151,7 @@ class Peak_finding():
         return diff*norm
 
     def wshed_peaks(self, img):
+        from skimage import measure, morphology
         if self.threshold == 0:
             self.threshold = 0.1 * np.sort(img.ravel())[-100:].mean()
         labels = morphology.label(img >= self.threshold, connectivity=1)
@@ -172,12 +177,7 @@ class Peak_finding():
 
         if roi_pos is None:
             roi_pos = np.zeros(2)
-        tf_points = []
-        for i in range(len(points)):
-            init = np.array([points[i,0], points[i,1], 1])
-            init[:2] -= roi_pos[:2]
-            tf_pt = tf_matrix @ init
-            tf_points.append(tf_pt[:2])
+        tf_points = point_transforms.apply(tf_matrix, np.asarray(points, dtype='f8')[:, :2] - roi_pos[:2])
 
         if store:
             if self.tf_peak_slices is None:
@@ -192,23 +192,10 @@ class Peak_finding():
             return tf_points[0]
 
     def calc_original_coordinates(self, point, tf_mat, flip, tf_shape):
-        if len(point) == 2:
-            point = np.array([point[0], point[1], 1])
-        if flip is None:
-            flip = [False, False, False, False]  # transp, rot, fliph, flipv
-        transp, rot, fliph, flipv = flip
-        if flipv:
-            point[1] = tf_shape[1] - point[1]
-        if fliph:
-            point[0] = tf_shape[0] - point[0]
-        if rot:
-            temp = tf_shape[0] - 1 - point[0]
-            point[0] = point[1]
-            point[1] = temp
-        if transp:
-            point = np.array([point[1], point[0], 1])
-        inv_point = (np.linalg.inv(tf_mat) @ point)[:2]
-        return inv_point
+        ''' Maps a point or (N, 2) array of points from the flipped, transformed view back to the original image '''
+        # flip is [transp, rot, fliph, flipv]
+        matrix = point_transforms.inverse(tf_mat) @ point_transforms.unflip_matrix(flip, tf_shape)
+        return point_transforms.apply(matrix, point)
 
     def fit_z(self, data, transformed, curr_slice=None, tf_matrix=None, flips=None, shape=None, local=False,
               point=None):
@@ -224,11 +211,7 @@ class Peak_finding():
                     tf_peaks = self.tf_peak_slices[-1]
                 else:
                     tf_peaks = self.tf_peak_slices[curr_slice]
-                peaks_2d = np.zeros_like(tf_peaks)
-                for k in range(tf_peaks.shape[0]):
-                    point = np.array([tf_peaks[k, 0], tf_peaks[k, 1], 1])
-                    orig_point = self.calc_original_coordinates(point, tf_matrix, flips, shape)
-                    peaks_2d[k] = orig_point
+                peaks_2d = self.calc_original_coordinates(tf_peaks, tf_matrix, flips, shape)
             else:
                 if curr_slice is None:
                     peaks_2d = self.peak_slices[-1]
@@ -249,64 +232,49 @@ class Peak_finding():
                 self.print('Calculate 2d peaks first!')
             return
 
-        z_profile = data[np.round(peaks_2d[:, 0]).astype(int), np.round(peaks_2d[:, 1]).astype(int)]
+        z_profile = data[np.round(peaks_2d[:, 0]).astype(int), np.round(peaks_2d[:, 1]).astype(int)].astype('f8')
         mean_int = np.median(np.max(z_profile, axis=1), axis=0)
-        max_int = np.max(z_profile)
         z_max = np.argmax(z_profile, axis=1)
-        x = np.arange(len(z_profile[0]))
-
-        gauss = lambda x, mu, sigma, offset: mean_int * np.exp(-(x - mu) ** 2 / (2 * sigma ** 2)) + offset
-
-        sigma_list = []
-        for i in range(len(z_profile)):
-            try:
-                z_peak = x[z_profile[i] > np.exp(-0.5) * z_profile[i].max()]
-                sigma_guess = 0.5 * (z_peak.max() - z_peak.min())
-                if sigma_guess == 0:
-                    sigma_guess = 2
-                offset = z_profile[i].min()
-                mask = np.zeros_like(z_profile[i]).astype(int)
-                mask[z_profile[i] == max_int] = 1
-                x_masked = np.ma.masked_array(x, mask)
-                z_masked = np.ma.masked_array(z_profile[i], mask)
-                popt, pcov = curve_fit(gauss, x_masked, z_masked, p0=[np.argmax(z_profile[i]), sigma_guess, offset])
-                if popt[0] > 0 and popt[0] < z_profile.shape[1]:
-                    sigma_list.append(popt[1])
-            except RuntimeError:
-                pass
+        x = np.arange(z_profile.shape[1])
+
+        # Initial sigma from the width of the profile above exp(-1/2) of its maximum
+        above = z_profile > np.exp(-0.5) * z_profile.max(1, keepdims=True)
+        first = np.argmax(above, axis=1)
+        last = z_profile.shape[1] - 1 - np.argmax(above[:, ::-1], axis=1)
+        sigma_guess = 0.5 * (last - first)
+        sigma_guess[sigma_guess == 0] = 2
+        offset = z_profile.min(1)
+
+        # All profiles are fitted at once, first with free sigma
+        p0 = np.array([z_max, sigma_guess, offset]).T
+        popt, perr, converged = self._fit_gauss_batch(x, z_profile, p0, mean_int)
         if local:
-            perr = np.sqrt(np.diag(pcov))[0]
-            self.print('Std z fit: ', perr)
-            self.peaks_z_std.append(perr)
-            self.z_profiles.append(z_profile[i])
-            return popt[0]
+            if not converged[0]:
+                self.print('Unable to fit z profile!')
+                return
+            self.print('Std z fit: ', perr[0, 0])
+            self.peaks_z_std.append(perr[0, 0])
+            self.z_profiles.append(z_profile[0])
+            return popt[0, 0]
         else:
-            if len(sigma_list) == 0:
+            valid = converged & (popt[:, 0] > 0) & (popt[:, 0] < z_profile.shape[1])
+            if not valid.any():
                 self.print('Z fitting of the beads failed. Contact developers!')
                 return
-            self.sigma_z = np.median(sigma_list)
-            gauss_static = lambda x, mu, offset: mean_int * np.exp(-(x - mu) ** 2 / (2 * self.sigma_z ** 2)) + offset
-            mean_values = []
-            for i in range(len(z_profile)):
-                try:
-                    mask = np.zeros_like(z_profile[i]).astype(int)
-                    mask[z_profile[i] == max_int] = 1
-                    x_masked = np.ma.masked_array(x, mask)
-                    z_masked = np.ma.masked_array(z_profile[i], mask)
-                    popt, pcov = curve_fit(gauss_static, x_masked, z_masked, p0=[np.argmax(z_profile[i]), offset])
-                    perr = np.sqrt(np.diag(pcov))
-                except RuntimeError:
-                    self.print('Runtime error for profile: ', i)
-                    self.print('Unable to fit z profile. Calculate argmax(z).')
-                    self.print('WARNING! Calculation of the z-position might be inaccurate!')
-                    mean_values.append(np.argmax(z_profile[i]))
-                    self.peaks_z_std.append(10)
-
-                perr = np.sqrt(np.diag(pcov))[0]
-                self.log('Std z fit: ', perr)
-                self.peaks_z_std.append(perr)
-                self.z_profiles.append(z_profile[i])
-                mean_values.append(popt[0])
+            self.sigma_z = np.median(popt[valid, 1])
+
+            # then with the median sigma of all beads
+            p0 = np.array([z_max, offset]).T
+            popt, perr, converged = self._fit_gauss_batch(x, z_profile, p0, mean_int, sigma=self.sigma_z)
+            for i in np.where(~converged)[0]:
+                self.print('Runtime error for profile: ', i)
+                self.print('Unable to fit z profile. Calculate argmax(z).')
+                self.print('WARNING! Calculation of the z-position might be inaccurate!')
+            mean_values = np.where(converged, popt[:, 0], z_max)
+            std_values = np.where(converged, perr[:, 0], 10)
+            self.log('Std z fit: ', std_values)
+            self.peaks_z_std.extend(std_values)
+            self.z_profiles.extend(z_profile)
 
             if transformed:
                 self.tf_peaks_z = np.copy(mean_values)
@@ -314,6 +282,69 @@ class Peak_finding():
                 self.peaks_z = np.copy(mean_values)
                 #np.save('z_values_tilted.npy', self.peaks_z)
 
+    def _fit_gauss_batch(self, x, profiles, p0, amplitude, sigma=None, max_iter=200, tol=1.49012e-8):
+        '''Levenberg-Marquardt fit of a gaussian with fixed amplitude to every row of profiles
+
+        p0 is (N, 3) with (mu, sigma, offset) or (N, 2) with (mu, offset) if sigma is fixed.
+        Returns the parameters, their standard errors (scaled like curve_fit) and a mask of
+        the converged fits.
+        '''
+        def model(p):
+            mu = p[:, :1]
+            sig = p[:, 1:2] if sigma is None else sigma
+            dx = x - mu
+            g = amplitude * np.exp(-dx ** 2 / (2 * sig ** 2))
+            jac = [g * dx / sig ** 2]
+            if sigma is None:
+                jac.append(g * dx ** 2 / sig ** 3)
+            jac.append(np.ones_like(g))
+            return g + p[:, -1:], np.stack(jac, axis=-1)
+
+        num, num_params = p0.shape
+        p = np.array(p0, dtype='f8')
+        with np.errstate(all='ignore'):
+            fit, jac = model(p)
+            cost = np.sum((profiles - fit) ** 2, axis=1)
+            lam = np.full(num, 1e-3)
+            active = np.ones(num, dtype=bool)
+            converged = np.zeros(num, dtype=bool)
+            for it in range(max_iter):
+                idx = np.where(active)[0]
+                if len(idx) == 0:
+                    break
+                res = profiles[idx] - fit[idx]
+                jtj = np.einsum('nzi,nzj->nij', jac[idx], jac[idx])
+                jtr = np.einsum('nzi,nz->ni', jac[idx], res)
+                damped = jtj + lam[idx, None, None] * (jtj * np.eye(num_params))
+                delta = (np.linalg.pinv(damped) @ jtr[:, :, None])[:, :, 0]
+                p_new = p[idx] + delta
+                fit_new, jac_new = model(p_new)
+                cost_new = np.sum((profiles[idx] - fit_new) ** 2, axis=1)
+
+                better = np.isfinite(cost_new) & (cost_new <= cost[idx])
+                done = better & ((cost[idx] - cost_new <= tol * cost[idx]) |
+                                 (np.linalg.norm(delta, axis=1) <= tol * (np.linalg.norm(p_new, axis=1) + tol)))
+                acc = idx[better]
+                p[acc] = p_new[better]
+                fit[acc] = fit_new[better]
+                jac[acc] = jac_new[better]
+                cost[acc] = cost_new[better]
+                lam[acc] /= 10
+                lam[idx[~better]] *= 10
+                converged[idx[done]] = True
+                active[idx[done]] = False
+                # No step improves the fit anymore, we are at the minimum
+                stuck = idx[~better][lam[idx[~better]] > 1e16]
+                converged[stuck] = True
+                active[stuck] = False
+
+            jtj = np.einsum('nzi,nzj->nij', jac, jac)
+            dof = max(profiles.shape[1] - num_params, 1)
+            pcov = np.linalg.pinv(jtj) * (cost / dof)[:, None, None]
+            perr = np.sqrt(np.abs(np.diagonal(pcov, axis1=1, axis2=2)))
+        converged &= np.isfinite(p).all(1) & np.isfinite(perr).all(1)
+        return p, perr, converged
+
     def calc_local_z(self, data, point, transformed, tf_matrix=None, flips=None, shape=None):
         if transformed:
             point = self.calc_original_coordinates(point, tf_matrix, flips, shape)
@@ -336,9 +367,7 @@ class Peak_finding():
             if self.peak_slices is not None and self.peak_slices[-1] is not None:
                 peaks_2d = self.peak_slices[-1]
 
-        diff = peaks_2d - point
-        diff_err = np.sqrt(diff[:, 0] ** 2 + diff[:, 1] ** 2)
-        ind_arr = np.where(diff_err < size / 2)[0]
+        ind_arr = self.get_peak_tree(peaks_2d).query_ball_point(np.asarray(point, dtype='f8')[:2], size / 2)
         if len(ind_arr) == 0:
             return None
         elif len(ind_arr) > 1:
@@ -346,87 +375,199 @@ class Peak_finding():
         else:
             return ind_arr[0]
 
-    def gauss_3d(self, point, transformed, channel=None):
-        def fit_func(mesh, mu_x, mu_y, mu_z, sigma_x, sigma_y, sigma_z, intens, offset):
-            x, y, z = mesh
-            return (intens * np.exp(-(x - mu_x) ** 2 / (2 * sigma_x **2)) * np.exp(-(y - mu_y) ** 2 / (2 * sigma_y ** 2)) *
-                    np.exp(-(z - mu_z) ** 2 / (2 * sigma_z ** 2)) + offset).ravel()
+    def get_peak_tree(self, peaks):
+        '''KD-tree of a peak set, for nearest-peak and within-radius queries
 
+        Trees are kept per peak array and rebuilt when a different array (or one of a
+        different shape) is passed. Call invalidate_peak_trees() after editing peaks in place.
+        '''
+        from scipy.spatial import cKDTree
+        entry = self._peak_trees.get(id(peaks))
+        if entry is None or entry[0] is not peaks or entry[1] != np.shape(peaks):
+            if len(self._peak_trees) > 8:
+                self._peak_trees = {}
+            entry = (peaks, np.shape(peaks), cKDTree(np.asarray(peaks, dtype='f8')[:, :2]))
+            self._peak_trees[id(peaks)] = entry
+        return entry[2]
+
+    def invalidate_peak_trees(self):
+        self._peak_trees = {}
+
+    def _fit_gauss_3d_batch(self, rois, mask, p0, lower, upper, max_iter=100, tol=1.49012e-8):
+        '''Bounded Levenberg-Marquardt fit of a separable 3D gaussian to every ROI
+
+        rois is (N, nx, ny, nz) and only voxels where mask is True enter the fit.
+        Parameters are (mu_x, mu_y, mu_z, sigma_x, sigma_y, sigma_z, intens, offset) in voxels
+        of the ROI and are kept within [lower, upper]. Returns the parameters, their covariance
+        (scaled like curve_fit) and the fitted model.
+        '''
+        axes = [np.arange(s, dtype='f8') for s in rois.shape[1:]]
+        weights = mask.reshape(len(rois), -1).astype('f8')
+        target = rois.reshape(len(rois), -1) * weights
+
+        def model(p, weights):
+            # 1D gaussians along each axis and their derivatives w.r.t. mu and sigma
+            gs, dmu, dsig = [], [], []
+            for i, ax in enumerate(axes):
+                d = ax - p[:, i:i+1]
+                s = p[:, i+3:i+4]
+                g = np.exp(-d ** 2 / (2 * s ** 2))
+                gs.append(g)
+                dmu.append(g * d / s ** 2)
+                dsig.append(g * d ** 2 / s ** 3)
+            def outer(a, b, c, out):
+                np.multiply(a[:, :, None, None] * b[:, None, :, None], c[:, None, None, :],
+                            out=out.reshape(len(p), *rois.shape[1:]))
+            intens = p[:, 6:7]
+            jac = np.empty((len(p), num_params, weights.shape[1]))
+            outer(intens * dmu[0], gs[1], gs[2], jac[:, 0])
+            outer(gs[0], intens * dmu[1], gs[2], jac[:, 1])
+            outer(gs[0], gs[1], intens * dmu[2], jac[:, 2])
+            outer(intens * dsig[0], gs[1], gs[2], jac[:, 3])
+            outer(gs[0], intens * dsig[1], gs[2], jac[:, 4])
+            outer(gs[0], gs[1], intens * dsig[2], jac[:, 5])
+            outer(*gs, jac[:, 6])
+            g = jac[:, 6].copy()
+            jac[:, 7] = 1
+            jac *= weights[:, None, :]
+            return (intens * g + p[:, 7:8]) * weights, jac
+
+        num, num_params = p0.shape
+        p = np.clip(np.array(p0, dtype='f8'), lower, upper)
+        with np.errstate(all='ignore'):
+            fit, jac = model(p, weights)
+            cost = np.sum((target - fit) ** 2, axis=1)
+            lam = np.full(num, 1e-3)
+            active = np.ones(num, dtype=bool)
+            for it in range(max_iter):
+                idx = np.where(active)[0]
+                if len(idx) == 0:
+                    break
+                res = target[idx] - fit[idx]
+                jac_idx = jac[idx]
+                jtj = jac_idx @ jac_idx.transpose(0, 2, 1)
+                jtr = (jac_idx @ res[:, :, None])[:, :, 0]
+                damped = jtj + lam[idx, None, None] * (jtj * np.eye(num_params))
+                delta = (np.linalg.pinv(damped) @ jtr[:, :, None])[:, :, 0]
+                p_new = np.clip(p[idx] + delta, lower[idx], upper[idx])
+                fit_new, jac_new = model(p_new, weights[idx])
+                cost_new = np.sum((target[idx] - fit_new) ** 2, axis=1)
+
+                better = np.isfinite(cost_new) & (cost_new <= cost[idx])
+                step = np.linalg.norm(p_new - p[idx], axis=1)
+                done = better & ((cost[idx] - cost_new <= tol * cost[idx]) |
+                                 (step <= tol * (np.linalg.norm(p_new, axis=1) + tol)))
+                acc = idx[better]
+                p[acc] = p_new[better]
+                fit[acc] = fit_new[better]
+                jac[acc] = jac_new[better]
+                cost[acc] = cost_new[better]
+                lam[acc] /= 10
+                lam[idx[~better]] *= 10
+                active[idx[done]] = False
+                # No step improves the fit anymore, we are at the minimum
+                active[idx[~better][lam[idx[~better]] > 1e16]] = False
+
+            jtj = jac @ jac.transpose(0, 2, 1)
+            dof = np.maximum(weights.sum(1) - num_params, 1)
+            pcov = np.linalg.pinv(jtj) * (cost / dof)[:, None, None]
+        return p, pcov, fit.reshape(rois.shape)
+
+    def gauss_3d_batch(self, points, transformed, channel=None, roi_size=10, chunk=8):
+        '''Fits a 3D gaussian around each of an (N, 2) array of points of interest
+
+        Returns the fitted positions (N, 3) in the current view with z scaled to xy pixels,
+        the standard errors (N, 3) and covariances (N, 3, 3) of x, y, z in voxels, the R^2
+        of every fit and a mask of the points that were within the image.
+        '''
         if channel is None:
             channel = self._channel_idx
-
+        points = np.atleast_2d(points)
         if transformed:
             flip_list = [self.transp, self.rot, self.fliph, self.flipv]
-            tf_aligned = self.tf_matrix @ self._color_matrices[channel]
-            point = self.calc_original_coordinates(point, tf_aligned, flip_list, self.data.shape[:-1])
+            tf_aligned = point_transforms.compose(self.tf_matrix, self._color_matrices[channel])
+            orig = self.calc_original_coordinates(points, tf_aligned, flip_list, self.data.shape[:-1])
         else:
-            point = np.linalg.inv(self._color_matrices[channel]) @ np.array([point[0], point[1], 1])
+            tf_aligned = self._color_matrices[channel]
+            orig = point_transforms.apply(point_transforms.inverse(tf_aligned), points)
+        nx, ny, nz = self.channel.shape
+        inside = (orig[:, 0] >= 0) & (orig[:, 1] >= 0) & (orig[:, 0] <= nx) & (orig[:, 1] <= ny)
+
+        # ROIs of all points as one (N, roi_size, roi_size, nz) array, voxels outside the image are masked
+        corner = np.round(orig - roi_size / 2).astype(int)
+        ix = corner[:, :1] + np.arange(roi_size)
+        iy = corner[:, 1:2] + np.arange(roi_size)
+        valid = (((ix >= 0) & (ix < nx))[:, :, None] & ((iy >= 0) & (iy < ny))[:, None, :]) & inside[:, None, None]
+        valid[~valid.any((1, 2))] = True
+        rois = np.asarray(self.channel[np.clip(ix, 0, nx - 1)[:, :, None], np.clip(iy, 0, ny - 1)[:, None, :]],
+                          dtype='f8')
+        mask = np.broadcast_to(valid[..., None], rois.shape)
+        num_vox = mask.sum((1, 2, 3))
+        offset = np.where(mask, rois, 0).sum((1, 2, 3)) / num_vox
+        max_int = np.where(mask, rois, -np.inf).max((1, 2, 3))
+
+        # Separable moments of the ROI above half maximum as initial guess, lower
+        # thresholds let the noise of the many background voxels pull the centroid away
+        half_max = (offset + max_int)[:, None, None, None] / 2
+        w = np.where(mask, np.clip(rois - half_max, 0, None), 0)
+        total = np.maximum(w.sum((1, 2, 3)), 1e-12)
+        mu, sig = [], []
+        for i, axis in enumerate([(2, 3), (1, 3), (1, 2)]):
+            proj = w.sum(axis)
+            coords = np.arange(proj.shape[1])
+            m = (proj * coords).sum(1) / total
+            mu.append(m)
+            sig.append(np.sqrt((proj * (coords - m[:, None]) ** 2).sum(1) / total))
+        center = roi_size / 2
+        z0 = rois[:, int(center), int(center)].argmax(1)
+
+        # Same bounds as before: positions within a quarter of the ROI, sigmas up to 2 voxels
+        lower = np.stack([np.full(len(points), center - roi_size / 4), np.full(len(points), center - roi_size / 4),
+                          z0 - nz / 4, *[np.full(len(points), 0.1)] * 3, offset, offset], axis=1)
+        upper = np.stack([np.full(len(points), center + roi_size / 4), np.full(len(points), center + roi_size / 4),
+                          z0 + nz / 4, *[np.full(len(points), 2.)] * 3, max_int, max_int], axis=1)
+        upper = np.maximum(upper, lower + 1e-6)
+        p0 = np.stack(mu + sig + [max_int, offset], axis=1)
+        p0[:, 3:6] = np.where(np.isfinite(p0[:, 3:6]) & (p0[:, 3:6] > 0), p0[:, 3:6], 1)
+
+        # Fit in chunks to keep the Jacobians small
+        popt, pcov, fit = [np.concatenate(r) for r in zip(*[
+            self._fit_gauss_3d_batch(rois[i:i+chunk], mask[i:i+chunk], p0[i:i+chunk], lower[i:i+chunk], upper[i:i+chunk])
+            for i in range(0, len(points), chunk)])]
+
+        ss_res = np.where(mask, (rois - fit) ** 2, 0).sum((1, 2, 3))
+        ss_tot = np.where(mask, (rois - offset[:, None, None, None]) ** 2, 0).sum((1, 2, 3))
+        with np.errstate(all='ignore'):
+            r2 = 1 - ss_res / ss_tot
+        perr = np.sqrt(np.abs(np.diagonal(pcov, axis1=1, axis2=2)))
+
+        pos = point_transforms.apply(tf_aligned, popt[:, :2] + corner)
+        z = (self.num_slices - 1 - popt[:, 2]) * self.voxel_size[2] / self.voxel_size[0]
+        init = np.column_stack([pos, z])
+        return init, perr[:, :3], pcov[:, :3, :3], r2, inside
 
-        if point[0] < 0 or point[1] < 0 or point[0] > self.orig_data.shape[0] or point[1] > self.orig_data.shape[1]:
+    def gauss_3d(self, point, transformed, channel=None):
+        init, perr, pcov, r2, inside = self.gauss_3d_batch(point, transformed, channel)
+        if not inside[0]:
             self.print('You have to select a point within the bounds of the image!')
             return None, None, None
-        roi_size = 10
-        x_min = np.round(point[0] - roi_size/2).astype(int)
-        x_max = np.round(point[0] + roi_size/2).astype(int)
-        y_min = np.round(point[1] - roi_size/2).astype(int)
-        y_max = np.round(point[1] + roi_size/2).astype(int)
-        data = self.channel[x_min:x_max, y_min:y_max, :]
         if self.my_counter is None:
             self.my_counter = 0
-        #np.save('virus{}.npy'.format(self.my_counter), data)
         self.my_counter += 1
-        offset = np.mean(data)
-        max_proj = np.max(data, axis=-1)
-        max_int = np.max(max_proj)
-        max_shape = np.array(data.shape).max()
-
-        x0, y0 = (data.shape[0]/2, data.shape[1]/2)
-        z0 = np.argmax(data[np.round(x0).astype(int), np.round(y0).astype(int), :])
-
-        #bounds for fitting params: x0, y0, z0, sigma_xy, sigma_z, intensity, offset
-        bounds = ((x0 - max_proj.shape[0] / 4, y0 - max_proj.shape[1] / 4, z0 - data.shape[-1] / 4, 0, 0, 0, np.mean(data),
-                   np.mean(data)), (
-                  x0 + max_proj.shape[0] / 4, y0 + max_proj.shape[1] / 4, z0 + data.shape[-1] / 4, 2, 2, 2, np.max(data),
-                  np.max(data)))
-
-        x = np.arange(max_shape)
-        x, y, z = np.meshgrid(x, x, x, indexing='ij')
-        data_pad = np.zeros_like(x).astype('f8')
-        data_pad[:data.shape[0], :data.shape[1], :data.shape[2]] = data
-
-        try:
-            popt, pcov = curve_fit(fit_func, (x, y, z), data_pad.ravel(), p0=[x0, y0, z0, 1, 1, 1, max_int, offset],
-                                   bounds=bounds)
-        except RuntimeError:
+        if not (np.isfinite(init[0]).all() and np.isfinite(perr[0]).all()):
             self.print('Unable to fit virus! Select another one!')
             return None, None, None
 
-        fit = fit_func((x, y, z), *popt).reshape(x.shape)[:data.shape[0], :data.shape[1], :data.shape[2]]
-        ss_res = np.sum((data - fit) ** 2)
-        ss_tot = np.sum((data - data.mean()) ** 2)
-        r2 = 1 - (ss_res / ss_tot)
-
-        perr = np.sqrt(np.diag(pcov))
-
-        if transformed:
-            tf_aligned = self.tf_matrix @ self._color_matrices[channel]
-            point = tf_aligned @ np.array([popt[0]+x_min, popt[1]+y_min, 1])
-        else:
-            point = self._color_matrices[channel] @ np.array([popt[0]+x_min, popt[1]+y_min, 1])
-
-        z = self.num_slices - 1 - popt[2]
-        scaling = self.voxel_size[2] / self.voxel_size[0]
-        z *= scaling
-        init = np.array([point[0], point[1], z])
-        self.log('Model fit: ', r2)
-        if r2 < 0.2:
+        self.log('Model fit: ', r2[0])
+        if not r2[0] >= 0.2:
             self.print('Model does not fit the data. You should consider selecting a different virus!')
             return None, None, None
         else:
-            self.print('Fitting succesful: ', init, ' Uncertainty: ', perr[:3]*self.voxel_size)
-            return init, perr[:3], pcov[:3,:3]
+            self.print('Fitting succesful: ', init[0], ' Uncertainty: ', perr[0]*self.voxel_size)
+            return init[0], perr[0], pcov[0]
 
     def reset_peaks(self):
+        self.invalidate_peak_trees()
         self.peak_slices = None
         self.tf_peak_slices = None
         self.orig_tf_peak_slices = None
@@ -0,0 +1,60 @@
+'''Batched homogeneous-coordinate transforms of point sets
+
+Points are (N, d) arrays of cartesian coordinates, matrices are (d+1, d+1) affine
+matrices acting on column vectors, as everywhere else in Clement. A single point
+of shape (d,) is accepted as well and returned with the same shape.
+'''
+
+import functools
+import numpy as np
+
+
+def apply(matrix, points):
+    ''' Maps points through matrix, returns cartesian (N, d) coordinates '''
+    matrix = np.asarray(matrix, dtype='f8')
+    points = np.asarray(points, dtype='f8')
+    dim = matrix.shape[0] - 1
+    single = points.ndim == 1
+    points = np.atleast_2d(points)[:, :dim]
+    out = points @ matrix[:dim, :dim].T + matrix[:dim, dim]
+    return out[0] if single else out
+
+
+@functools.lru_cache(maxsize=64)
+def _inverse(matrix_bytes, shape):
+    inv = np.linalg.inv(np.frombuffer(matrix_bytes, dtype='f8').reshape(shape))
+    inv.flags.writeable = False
+    return inv
+
+
+def inverse(matrix):
+    ''' Inverse of matrix, cached on its contents. The result is read-only '''
+    matrix = np.ascontiguousarray(matrix, dtype='f8')
+    return _inverse(matrix.tobytes(), matrix.shape)
+
+
+def compose(*matrices):
+    ''' Product of matrices, compose(A, B) applies B first and then A '''
+    return functools.reduce(np.matmul, [np.asarray(m, dtype='f8') for m in matrices])
+
+
+def unflip_matrix(flip, shape):
+    '''3x3 matrix undoing the view flips of an image of the given (transformed) shape
+
+    flip is [transp, rot, fliph, flipv] as used by the FM view. The flips are undone in
+    the order flipv, fliph, rot, transp.
+    '''
+    if flip is None:
+        return np.identity(3)
+    transp, rot, fliph, flipv = flip
+    nx, ny = shape[0], shape[1]
+    matrix = np.identity(3)
+    if flipv:
+        matrix = np.array([[1, 0, 0], [0, -1, ny], [0, 0, 1]]) @ matrix
+    if fliph:
+        matrix = np.array([[-1, 0, nx], [0, 1, 0], [0, 0, 1]]) @ matrix
+    if rot:
+        matrix = np.array([[0, 1, 0], [-1, 0, nx - 1], [0, 0, 1]]) @ matrix
+    if transp:
+        matrix = np.array([[0, 1, 0], [1, 0, 0], [0, 0, 1]]) @ matrix
+    return matrix
@@ -15,6 +15,7 @@ from uncertainties import unumpy
 warnings.simplefilter('ignore', category=FutureWarning)
 
 from . import utils
+from .base_controls import TiledImageView
 
 class MplCanvas(FigureCanvas):
     def __init__(self, parent=None, width=5, height=4, dpi=100):
@@ -575,6 +576,7 @@ class Peak_Params(QtWidgets.QMainWindow):
             if self.coor is not None:
                 for i in range(len(self.fm.ops.peak_slices[-1])):
                     self.fm.ops.peak_slices[-1][i] = self.coor[:,peaks_2d[i][0].astype(np.int), peaks_2d[i][1].astype(np.int)]
+                self.fm.ops.invalidate_peak_trees()
 
         self.fm.ops.adjusted_params = True
 
@@ -611,7 +613,6 @@ class Merge(QtGui.QMainWindow):
 
         self.curr_mrc_folder_popup = self.parent.fm_controls.other.curr_folder
         self.num_slices_popup = self.parent.fm_controls.num_slices
-        self.downsampling = 2  # per dimension
         self.color_data_popup = None
         self.color_overlay_popup = None
         self.annotations_popup = []
@@ -640,10 +641,8 @@ class Merge(QtGui.QMainWindow):
         merged_data = self.parent.em.merged[self.parent.fib_controls.tab_index]
         if self.parent.fib_controls.tab_index == 1:
             self.fib = True
-            self.downsampling = 1
         else:
             self.fib = False
-            self.downsampling = 1
         if merged_data is not None:
             self.log(self._colors_popup)
             self.data_popup = np.copy(merged_data)
@@ -683,7 +682,8 @@ class Merge(QtGui.QMainWindow):
         filemenu.addAction(action)
         #self._set_theme_popup(self.theme)
 
-        self.imview_popup = pg.ImageView()
+        # Full resolution data, the image item displays the pyramid level matching the zoom
+        self.imview_popup = TiledImageView()
         self.imview_popup.ui.roiBtn.hide()
         self.imview_popup.ui.menuBtn.hide()
         self.imview_popup.scene.sigMouseClicked.connect(lambda evt: self._imview_clicked_popup(evt))
@@ -847,7 +847,7 @@ class Merge(QtGui.QMainWindow):
                 size = sizes[i]
                 point = unumpy.uarray([pos.x() + size[0] // 2, pos.y() + size[1] // 2, 1], [std[0], std[1], 0])
                 transf = tot_matrix @ point
-                transf_points.append(unumpy.nominal_values(transf)[:2] / self.downsampling)
+                transf_points.append(unumpy.nominal_values(transf)[:2])
                 transf_err.append(unumpy.std_devs(transf)[:2])
                 cov_i = np.array(covs[i])
                 cov_i[-1,-1] = 0
@@ -940,22 +940,19 @@ class Merge(QtGui.QMainWindow):
 
     @utils.wait_cursor('print')
     def _calc_color_channels_popup(self, state=None):
-        self.color_data_popup = np.zeros(
-            (len(self._channels_popup), int(np.ceil(self.data_popup.shape[0] / self.downsampling)),
-             int(np.ceil(self.data_popup.shape[1] / self.downsampling)), 3))
+        self.color_data_popup = np.zeros((len(self._channels_popup),) + self.data_popup.shape[:2] + (3,))
         if not self.parent.fm._show_mapping:
             for i in range(len(self._channels_popup)):
                 if self._channels_popup[i]:
-                    my_channel = self.data_popup[::self.downsampling, ::self.downsampling, i]
+                    my_channel = self.data_popup[:, :, i]
                     my_channel_rgb = np.repeat(my_channel[:, :, np.newaxis], 3, axis=2)
                     rgb = tuple([int(self._colors_popup[i][1 + 2 * c:3 + 2 * c], 16) / 255. for c in range(3)])
                     self.color_data_popup[i, :, :, :] = my_channel_rgb * rgb
                 else:
-                    self.color_data_popup[i, :, :, :] = np.zeros(
-                        (self.data_popup[::self.downsampling, ::self.downsampling, 0].shape + (3,)))
+                    self.color_data_popup[i, :, :, :] = np.zeros((self.data_popup.shape[:2] + (3,)))
         else:
-            self.color_data_popup[0, :, :, :] = hsv2rgb(self.data_popup[::self.downsampling, ::self.downsampling, :3])
-            em_img = self.data_popup[::self.downsampling, ::self.downsampling, -1]
+            self.color_data_popup[0, :, :, :] = hsv2rgb(self.data_popup[:, :, :3])
+            em_img = self.data_popup[:, :, -1]
             em_img_rgb = np.repeat(em_img[:, :, np.newaxis], 3, axis=2)
             rgb = tuple([int(self._colors_popup[-1][1 + 2 * c:3 + 2 * c], 16) / 255. for c in range(3)])
             self.color_data_popup[-1, :, :, :] = em_img_rgb * rgb
@@ -991,7 +988,7 @@ class Merge(QtGui.QMainWindow):
                 self.stage_positions_popup = None
                 self.coordinates = []
         else:
-            self.coordinates = np.array([self.downsampling * np.array([point.x() + self.lambda_1 / 2, point.y() + self.lambda_2 / 2]) for point in
+            self.coordinates = np.array([np.array([point.x() + self.lambda_1 / 2, point.y() + self.lambda_2 / 2]) for point in
                            self._clicked_points_popup])
             self.coordinates[:,1] = self.data_popup.shape[1] - self.coordinates[:,1]
 
@@ -4,7 +4,6 @@ import numpy as np
 from PyQt5 import QtWidgets, QtGui, QtCore
 import pyqtgraph as pg
 from operator import itemgetter
-import yaml
 import copy
 
 
@@ -25,6 +24,7 @@ class Project(QtWidgets.QWidget):
         self.logger = logger
 
     def _load_project(self, file_name=None):
+        import yaml
         if file_name is None:
             file_name, _ = QtWidgets.QFileDialog.getOpenFileName(self,
                                                                  'Select project',
@@ -38,6 +38,7 @@ class Project(QtWidgets.QWidget):
             self.fib.reset_init()
             self.parent.tabs.setCurrentIndex(0)
             self._project_folder = os.path.dirname(file_name)
+            self.fm.scratch_folder = self.scratch_folder()
             with open(file_name, 'r') as f:
                 project = yaml.load(f, Loader=yaml.FullLoader)
                 # For numpy array debugging only!
@@ -48,6 +49,10 @@ class Project(QtWidgets.QWidget):
             self._load_em(project, sem=False)
             self._load_base(project)
 
+    def scratch_folder(self):
+        ''' Folder for the decoded FM volumes of the current project '''
+        return os.path.join(self._project_folder, 'clement_scratch')
+
     def _load_fm(self, project):
         if 'FM' not in project:
             return
@@ -58,7 +63,7 @@ class Project(QtWidgets.QWidget):
         self.parent.colors = self.fm._colors
         if 'Series' in fmdict:
             self.fm._series = fmdict['Series']
-        self.fm._parse_fm_images(self.fm._file_name, self.fm._series)
+        self.fm._parse_fm_images(self.fm._file_name, self.fm._series, background=False)
 
         undo_max_proj = False
         if fmdict['Max projection']:
@@ -147,8 +152,8 @@ class Project(QtWidgets.QWidget):
         em.assemble_btn.setEnabled(True)
         em.step_box.setEnabled(True)
         em.step_box.setText(emdict['Downsampling'])
-        em._load_mrc(jump=True)
-        em._assemble_mrc()
+        em._load_mrc(jump=True, background=False)
+        em._assemble_mrc(background=False)
         if emdict['Transpose']:
             em.transp_btn.setEnabled(True)
             em.transp_btn.setChecked(True)
@@ -236,7 +241,7 @@ class Project(QtWidgets.QWidget):
         self.fib._curr_folder = fibdict['Directory']
         self.fib._file_name = fibdict['File']
         self.fib.mrc_fname.setText(self.fib._file_name)
-        self.fib._load_mrc(jump=True)
+        self.fib._load_mrc(jump=True, background=False)
         if fibdict['Transpose']:
             self.fib.transp_btn.setEnabled(True)
             self.fib.transp_btn.setChecked(True)
@@ -430,6 +435,7 @@ class Project(QtWidgets.QWidget):
                 self._do_save()
 
     def _do_save(self):
+        import yaml
         file_name, _ = QtWidgets.QFileDialog.getSaveFileName(self,
                                                              'Save project',
                                                              self._project_folder,
@@ -452,6 +458,7 @@ class Project(QtWidgets.QWidget):
             if self.merged:
                 self._save_merge(project['MERGE'])
             self._project_folder = os.path.dirname(file_name)
+            self.fm.scratch_folder = self.scratch_folder()
             with open(file_name, 'w') as fptr:
                 yaml.dump(project, fptr)
 
@@ -0,0 +1,91 @@
+import numpy as np
+from collections import OrderedDict
+
+
+def downsample_2x(img):
+    ''' 2x2 box filter over the first two axes, odd edges are padded by replication '''
+    pad = [(0, img.shape[0] % 2), (0, img.shape[1] % 2)] + [(0, 0)] * (img.ndim - 2)
+    if pad[0][1] or pad[1][1]:
+        img = np.pad(img, pad, mode='edge')
+    out = img[0::2, 0::2].astype('f4')
+    out += img[1::2, 0::2]
+    out += img[0::2, 1::2]
+    out += img[1::2, 1::2]
+    out *= 0.25
+    return out
+
+
+class Pyramid():
+    '''Lazy, tiled multi-resolution pyramid of an image
+
+    Level 0 is the image itself (never copied), every further level is a 2x box-filtered
+    version of the previous one, down to min_size pixels along the longer axis.
+    Levels above 0 are only computed tile by tile when a region of them is requested,
+    and tiles are kept in an LRU cache of at most cache_bytes.
+    Coordinates always refer to level 0, level k covers 2**k level-0 pixels per pixel.
+    '''
+    def __init__(self, data, min_size=512, tile_size=512, cache_bytes=512*1024**2):
+        self.data = data
+        self.tile_size = tile_size
+        self.cache_bytes = cache_bytes
+        self.shapes = [tuple(data.shape[:2])]
+        while max(self.shapes[-1]) > min_size:
+            self.shapes.append(tuple((s + 1) // 2 for s in self.shapes[-1]))
+        self._tiles = OrderedDict()
+        self._cached_bytes = 0
+        self._sample = None
+
+    def __len__(self):
+        return len(self.shapes)
+
+    def get_level(self, pixel_size):
+        ''' Coarsest level that still has at least one pixel per screen pixel
+
+        pixel_size is the number of level-0 pixels covered by one screen pixel
+        '''
+        if pixel_size <= 1:
+            return 0
+        return min(int(np.floor(np.log2(pixel_size))), len(self.shapes) - 1)
+
+    def get_tile(self, level, i, j):
+        ''' Tile (i, j) of a level > 0, computed from the level below on first access '''
+        key = (level, i, j)
+        tile = self._tiles.get(key)
+        if tile is not None:
+            self._tiles.move_to_end(key)
+            return tile
+
+        t = self.tile_size
+        nx, ny = self.shapes[level - 1]
+        tile = downsample_2x(self.get_region(level - 1, 2 * i * t, min(2 * (i + 1) * t, nx),
+                                             2 * j * t, min(2 * (j + 1) * t, ny)))
+        self._tiles[key] = tile
+        self._cached_bytes += tile.nbytes
+        while self._cached_bytes > self.cache_bytes and len(self._tiles) > 1:
+            self._cached_bytes -= self._tiles.popitem(last=False)[1].nbytes
+        return tile
+
+    def get_region(self, level, x0, x1, y0, y1):
+        ''' Region [x0:x1, y0:y1] of a level, in pixels of that level '''
+        if level == 0:
+            return self.data[x0:x1, y0:y1]
+        t = self.tile_size
+        i0, i1 = x0 // t, (x1 - 1) // t + 1
+        j0, j1 = y0 // t, (y1 - 1) // t + 1
+        rows = [np.concatenate([self.get_tile(level, i, j) for j in range(j0, j1)], axis=1)
+                for i in range(i0, i1)]
+        region = rows[0] if len(rows) == 1 else np.concatenate(rows, axis=0)
+        return region[x0 - i0 * t:x1 - i0 * t, y0 - j0 * t:y1 - j0 * t]
+
+    def get_sample(self, size=512):
+        ''' Cached strided subsample of level 0 with about size pixels along each axis '''
+        if self._sample is None:
+            step = [max(1, s // size) for s in self.shapes[0]]
+            self._sample = np.array(self.data[::step[0], ::step[1]])
+        return self._sample
+
+    def is_for(self, data):
+        ''' True if level 0 is the same memory as data '''
+        base = self.data
+        return (data is not None and base.shape == data.shape and base.strides == data.strides and
+                base.__array_interface__['data'][0] == data.__array_interface__['data'][0])
@@ -2,43 +2,75 @@ import numpy as np
 
 
 class Ransac():
-    def __init__(self, x, y, n, rad):
-        self.x = x
-        self.y = y
+    def __init__(self, x, y, n, rad, refit=False, inlier_tol=1., seed=None):
+        self.x = np.asarray(x, dtype='f8')
+        self.y = np.asarray(y, dtype='f8')
         self.rad = rad
         self.n = n
+        self.refit = refit
+        self.inlier_tol = inlier_tol
         self.err_max = 99999
         self.best_fit = None
+        self.rng = np.random.default_rng(seed)
 
-    def get_subsample(self):
-        sample = []
-        indices = []
-        while len(sample) < 3:
-            idx = np.random.randint(len(self.x))
-            if idx not in indices:
-                point = np.array((self.x[idx], self.y[idx]))
-                sample.append(point)
-                indices.append(idx)
-        return sample
+    def get_subsamples(self, n=None):
+        ''' Indices (n, 3) of n random triples of distinct edge points '''
+        n = self.n if n is None else n
+        num = len(self.x)
+        # The second and third index are drawn from the remaining points and shifted past the ones taken
+        i0 = self.rng.integers(num, size=n)
+        i1 = self.rng.integers(num - 1, size=n)
+        i1 += i1 >= i0
+        i2 = self.rng.integers(num - 2, size=n)
+        i2 += i2 >= np.minimum(i0, i1)
+        i2 += i2 >= np.maximum(i0, i1)
+        return np.array([i0, i1, i2]).T
 
-    def calc_center(self, sample):
-        A = np.array([sample[1] - sample[0], sample[2] - sample[1]])
-        B = np.array([(sample[1] ** 2 - sample[0] ** 2).sum(), (sample[2] ** 2 - sample[1] ** 2).sum()])
-        c_x, c_y = np.linalg.inv(A) @ B / 2
-        return c_x, c_y
+    def calc_centers(self, ind):
+        ''' Circumcenters (m, 2) of the triples, collinear triples are dropped '''
+        x, y = self.x[ind], self.y[ind]
+        a00, a01 = x[:, 1] - x[:, 0], y[:, 1] - y[:, 0]
+        a10, a11 = x[:, 2] - x[:, 1], y[:, 2] - y[:, 1]
+        b0 = (x[:, 1] ** 2 - x[:, 0] ** 2 + y[:, 1] ** 2 - y[:, 0] ** 2) / 2
+        b1 = (x[:, 2] ** 2 - x[:, 1] ** 2 + y[:, 2] ** 2 - y[:, 1] ** 2) / 2
+        det = a00 * a11 - a01 * a10
+        valid = np.abs(det) > 1e-9
+        det = det[valid]
+        c_x = (b0[valid] * a11[valid] - a01[valid] * b1[valid]) / det
+        c_y = (a00[valid] * b1[valid] - b0[valid] * a10[valid]) / det
+        return np.array([c_x, c_y]).T
 
-    def check_model(self, model):
-        err = 0
-        c_x, c_y = model
-        for i in range(len(self.x)):
-            d = np.sqrt((self.x[i] - c_x) ** 2 + (self.y[i] - c_y) ** 2)
-            err += np.abs(d - self.rad)
-        return err
+    def check_models(self, centers):
+        ''' Sum of absolute radial deviations of all edge points for every model '''
+        d = np.sqrt((self.x - centers[:, :1]) ** 2 + (self.y - centers[:, 1:]) ** 2)
+        return np.abs(d - self.rad).sum(1)
+
+    def refit_circle(self, center):
+        ''' Algebraic least-squares circle fit on the inliers of center '''
+        d = np.sqrt((self.x - center[0]) ** 2 + (self.y - center[1]) ** 2)
+        inliers = np.abs(d - self.rad) < self.inlier_tol
+        if inliers.sum() < 3:
+            return center
+        x, y = self.x[inliers], self.y[inliers]
+        A = np.array([x, y, np.ones_like(x)]).T
+        sol = np.linalg.lstsq(A, x ** 2 + y ** 2, rcond=None)[0]
+        return sol[0] / 2, sol[1] / 2
 
     def run(self):
-        for i in range(self.n):
-            center = self.calc_center(self.get_subsample())
-            err = self.check_model(center)
-            if err < self.err_max:
-                self.best_fit = center
-                self.err_max = err
+        if len(self.x) < 3:
+            return
+        centers = self.calc_centers(self.get_subsamples())
+        # Collinear triples are replaced by new draws, so that n models are scored
+        for i in range(10):
+            if len(centers) == self.n:
+                break
+            centers = np.concatenate([centers, self.calc_centers(self.get_subsamples(self.n - len(centers)))])
+        if len(centers) == 0:
+            return
+        err = self.check_models(centers)
+        best = np.argmin(err)
+        if err[best] < self.err_max:
+            self.best_fit = tuple(centers[best])
+            self.err_max = err[best]
+            if self.refit:
+                self.best_fit = self.refit_circle(self.best_fit)
@@ -57,29 +57,41 @@ class TEMControls(BaseControls):
 
         self.show()
 
-    def _load_mrc(self, jump=False):
+    def _load_mrc(self, jump=False, background=True):
+        file_name = self._file_name
         if not jump:
             if self._curr_folder is None:
                 self._curr_folder = os.getcwd()
-            self._file_name, _ = QtWidgets.QFileDialog.getOpenFileName(self,
-                                                                 'Select TEM data',
-                                                                 self._curr_folder,
-                                                                 'All (*.tif *.tiff *.mrc);;*.mrc;;*.tif;;*tiff')
-            self._curr_folder = os.path.dirname(self._file_name)
-
-        if self._file_name != '':
-            if self.ops is not None:
-                self.reset_init()
-            self.mrc_fname.setText(os.path.basename(self._file_name))
-            self.assemble_btn.setEnabled(True)
-            self.step_box.setEnabled(True)
-
-            self.ops = EM_ops(self.print, self.log)
-            self.ops.parse_2d(self._file_name)
-            if len(self.ops.dimensions) == 2:
-                self.step_box.setText('1')
-                self._assemble_mrc()
-                self.assemble_btn.setEnabled(False)
+            file_name, _ = QtWidgets.QFileDialog.getOpenFileName(self,
+                                                           'Select TEM data',
+                                                           self._curr_folder,
+                                                           'All (*.tif *.tiff *.mrc);;*.mrc;;*.tif;;*tiff')
+            self._curr_folder = os.path.dirname(file_name)
+
+        if file_name != '':
+            self.mrc_fname.setText(os.path.basename(file_name))
+
+            def load(task):
+                ops = EM_ops(task.print, task.log)
+                ops.parse_2d(file_name)
+                return ops
+
+            self._start_loader(load, lambda ops: self._mrc_loaded(file_name, ops, background), 'Loading', background)
+
+    def _mrc_loaded(self, file_name, ops, background=True):
+        # The current view is only reset once the new file has been read
+        if self.ops is not None:
+            self.reset_init()
+        self._file_name = file_name
+        ops.print = self.print
+        ops.log = self.log
+        self.ops = ops
+        self.assemble_btn.setEnabled(True)
+        self.step_box.setEnabled(True)
+        if len(self.ops.dimensions) == 2:
+            self.step_box.setText('1')
+            self._assemble_mrc(background=background)
+            self.assemble_btn.setEnabled(False)
 
     @utils.wait_cursor('print')
     def _update_imview(self, state=None):
@@ -89,6 +101,7 @@ class TEMControls(BaseControls):
             if old_shape == new_shape:
                 vr = self.imview.getImageItem().getViewBox().targetRect()
             levels = self.imview.getHistogramWidget().item.getLevels()
+            self.imview.getImageItem().set_pyramid(self.ops.get_pyramid())
             self.imview.setImage(self.ops.data, levels=levels)
             if old_shape == new_shape:
                 self.imview.getImageItem().getViewBox().setRange(vr, padding=0)
@@ -100,38 +113,32 @@ class TEMControls(BaseControls):
                 self.show_boxes = False
 
     @utils.wait_cursor('print')
-    def _assemble_mrc(self, state=None):
-        if self.step_box.text() == '':
-            self._downsampling = 10
-        else:
-            self._downsampling = self.step_box.text()
-
-        if self._file_name != '':
-            if len(self.ops.dimensions) == 3:
-                self.ops.parse_3d(int(self._downsampling), self._file_name)
-            self.imview.setImage(self.ops.data)
-            self.define_btn.setEnabled(True)
-            self.show_btn.setChecked(True)
-            self.transform_btn.setEnabled(False)
-            #self.rot_transform_btn.setEnabled(False)
-            self.transp_btn.setEnabled(True)
-            if self.tr_grid_box is not None:
-                self.imview.removeItem(self.tr_grid_box)
-            if self.grid_box is not None:
-                self.imview.removeItem(self.grid_box)
-            self.grid_box = None
-            self.ops._transformed = False
-            self.show_grid_btn.setEnabled(False)
+    def _mrc_assembled(self, ops):
+        ops.print = self.print
+        ops.log = self.log
+        self.ops = ops
+        self.imview.getImageItem().set_pyramid(self.ops.get_pyramid())
+        self.imview.setImage(self.ops.data)
+        self.define_btn.setEnabled(True)
+        self.show_btn.setChecked(True)
+        self.transform_btn.setEnabled(False)
+        #self.rot_transform_btn.setEnabled(False)
+        self.transp_btn.setEnabled(True)
+        if self.tr_grid_box is not None:
+            self.imview.removeItem(self.tr_grid_box)
+        if self.grid_box is not None:
+            self.imview.removeItem(self.grid_box)
+        self.grid_box = None
+        self.ops._transformed = False
+        self.show_grid_btn.setEnabled(False)
 
-            if self.ops.stacked_data:
-                self.select_region_btn.setEnabled(True)
-            else:
-                self.select_region_btn.setEnabled(False)
-                self.show_assembled_btn.setEnabled(False)
-            self.boxes = []
-            self.show_grid_btn.setChecked(False)
+        if self.ops.stacked_data:
+            self.select_region_btn.setEnabled(True)
         else:
-            self.print('You have to choose a file first!')
+            self.select_region_btn.setEnabled(False)
+            self.show_assembled_btn.setEnabled(False)
+        self.boxes = []
+        self.show_grid_btn.setChecked(False)
 
     @utils.wait_cursor('print')
     def _transpose(self, state=None):
@@ -271,6 +278,8 @@ class TEMControls(BaseControls):
     def reset_init(self, state=None):
         #self.ops = None
         #self.other = None # The other controls object
+        if self.ops is not None:
+            self.ops.close()
         if self.show_grid_btn.isChecked():
             if self.ops._transformed:
                 self.imview.removeItem(self.tr_grid_box)
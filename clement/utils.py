@@ -40,6 +40,10 @@ def add_montage_line(parent, vbox, type_str, downsampling=False):
     line.addWidget(button)
     parent.mrc_fname = QtWidgets.QLabel(parent)
     line.addWidget(parent.mrc_fname, stretch=1)
+    parent.cancel_load_btn = QtWidgets.QPushButton('Cancel', parent)
+    parent.cancel_load_btn.clicked.connect(parent._cancel_loader)
+    parent.cancel_load_btn.setEnabled(False)
+    line.addWidget(parent.cancel_load_btn)
 
     if downsampling:
         line = QtWidgets.QHBoxLayout()
@@ -103,6 +107,9 @@ def add_fmpeaks_line(parent, vbox):
     parent.auto_opt_btn.setEnabled(False)
     parent.auto_opt_btn.clicked.connect(parent.fit_circles)
     line.addWidget(parent.auto_opt_btn)
+    parent.refit_btn = QtWidgets.QCheckBox('Least-squares refit', parent)
+    parent.refit_btn.setChecked(False)
+    line.addWidget(parent.refit_btn)
     line.addStretch(1)
 
 def add_define_grid_line(parent, vbox):
@@ -198,4 +205,74 @@ class PrintGUI(QtCore.QObject):
         fname = dtime.strftime('%Y%m%d_%H%M%S.txt')
         self.log_file = open(os.path.join(tot_path,fname), 'a')
 
-        print(tot_path)
\ No newline at end of file
+        print(tot_path)
+
+
+class Cancelled(Exception):
+    ''' Raised inside a BackgroundTask when it has been cancelled '''
+
+
+class BackgroundTask(QtCore.QRunnable):
+    '''Runs func(task) on the global QThreadPool
+
+    func can report messages with task.progress() and should return early when
+    task.cancelled is set. task.set_progress(done, total) also raises Cancelled
+    once the task is cancelled, so it can be passed as progress callback to long
+    loops. task.print and task.log can be used as printer and logger of objects
+    living in the worker. The signals are emitted from the worker and delivered in
+    the thread that created the task, so their slots may update the GUI. Nothing
+    is emitted anymore once the task is cancelled.
+    '''
+    class Signals(QtCore.QObject):
+        progress = QtCore.pyqtSignal(str)
+        advanced = QtCore.pyqtSignal(int, int)
+        printed = QtCore.pyqtSignal(object)
+        logged = QtCore.pyqtSignal(object)
+        finished = QtCore.pyqtSignal(object)
+        failed = QtCore.pyqtSignal(str)
+
+    def __init__(self, func):
+        super(BackgroundTask, self).__init__()
+        self.func = func
+        self.signals = BackgroundTask.Signals()
+        self.cancelled = False
+        self._percent = None
+
+    def start(self):
+        QtCore.QThreadPool.globalInstance().start(self)
+        return self
+
+    def cancel(self):
+        self.cancelled = True
+
+    def progress(self, message):
+        if not self.cancelled:
+            self.signals.progress.emit(message)
+
+    def set_progress(self, done, total):
+        if self.cancelled:
+            raise Cancelled
+        # Only whole percent steps are sent to the GUI
+        percent = 100 * done // max(total, 1)
+        if percent != self._percent:
+            self._percent = percent
+            self.signals.advanced.emit(int(done), int(total))
+
+    def print(self, *args):
+        if not self.cancelled:
+            self.signals.printed.emit(args)
+
+    def log(self, *args):
+        self.signals.logged.emit(args)
+
+    def run(self):
+        try:
+            result = self.func(self)
+        except Cancelled:
+            return
+        except Exception:
+            if not self.cancelled:
+                self.signals.failed.emit(traceback.format_exc())
+            return
+        if not self.cancelled:
+            self.signals.finished.emit(result)
@@ -26,7 +26,6 @@ setuptools.setup(
         'numpy',
         'scipy>=1.0.0',
         'scikit-image',
-        'scikit-learn',
         'pyqt5',
         'numexpr',
         'mrcfile',